@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import re
+import shutil
+from config import OUTPUT_DIR
+from workflow import AutoQASystem
+from modules.batch_client import create_batch_clients
+
+def load_jobs(path: str) -> list:
+    """读取任务文件：每行一个 JSON，包含 question、cognitive、goal，可选 custom_branch 与 name"""
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                jobs.append(json.loads(line))
+    return jobs
+
+def _batch_name(jobs_path: str) -> str:
+    return os.path.splitext(os.path.basename(jobs_path))[0]
+
+def session_folder(root: str, jobs_path: str, run_id: str, index: int, job: dict) -> str:
+    """会话目录由任务文件名、任务序号、名称与运行ID决定，同一次运行恢复时写回同一目录，重新运行则写入新目录。
+    目录直接放在会话根目录下，命名与交互式会话一致（以时间戳结尾），共用同一个索引（catalog.py）。"""
+    name = job.get("name") or re.sub(r"\W+", "_", job["question"]).strip("_")
+    return os.path.join(root, f"{_batch_name(jobs_path)}_{index + 1:03d}_{name}_{run_id}")
+
+def checkpoint_folder(root: str, jobs_path: str, run_id: str) -> str:
+    """每次运行使用独立的检查点目录，重新运行不会返回以前的结果"""
+    return os.path.join(root, f"{_batch_name(jobs_path)}_{run_id}")
+
+async def run_jobs(jobs_path: str, output_root: str, checkpoint_root: str, run_id: str, base_url: str = None,
+                   collect_window: float = 2.0, poll_interval: float = 30.0) -> bool:
+    """运行任务文件中的全部任务；全部成功时删除本次运行的检查点并返回 True"""
+    jobs = load_jobs(jobs_path)
+    checkpoint_dir = checkpoint_folder(checkpoint_root, jobs_path, run_id)
+    batch_clients = create_batch_clients(
+        checkpoint_dir, base_url=base_url, collect_window=collect_window, poll_interval=poll_interval
+    )
+    print(f"共 {len(jobs)} 个任务，运行ID：{run_id}，检查点目录：{checkpoint_dir}")
+
+    async def run(index: int, job: dict):
+        system = AutoQASystem(output_dir=session_folder(output_root, jobs_path, run_id, index, job), batch_clients=batch_clients)
+        return await system.execute_workflow(
+            job["question"], job.get("cognitive", ""), job.get("goal", ""), job.get("custom_branch", "")
+        )
+
+    # 所有任务同时运行，它们同一阶段的请求会被合并进同一个批次；每个任务的用量各自记入自己的会话清单
+    results = await asyncio.gather(*[run(i, job) for i, job in enumerate(jobs)], return_exceptions=True)
+    for i, (job, result) in enumerate(zip(jobs, results)):
+        if isinstance(result, Exception):
+            print(f"[{i + 1}] 失败：{job['question']}（{result}）")
+        else:
+            print(f"[{i + 1}] 完成：{job['question']} -> {session_folder(output_root, jobs_path, run_id, i, job)}")
+
+    if any(isinstance(result, Exception) for result in results):
+        print(f"部分任务失败，检查点已保留；使用 --resume {run_id} 从已完成的阶段继续")
+        return False
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    print("全部任务完成，已清除本次运行的检查点")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批处理模式：通过批处理接口离线运行一组问题，适合不关心延迟的夜间任务")
+    parser.add_argument("jobs", help="任务文件（JSONL），每行包含 question、cognitive、goal，可选 custom_branch 与 name")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="会话目录的根目录（默认与交互式会话相同，便于 catalog.py 统一查询）")
+    parser.add_argument("--checkpoint-dir", default=os.path.join(OUTPUT_DIR, ".batch_checkpoints"),
+                        help="检查点根目录，每次运行在其中使用 <任务文件名>_<运行ID> 子目录")
+    parser.add_argument("--resume", metavar="RUN_ID", help="继续之前中断或部分失败的运行，从已完成的阶段继续并写回同一组会话目录")
+    parser.add_argument("--base-url", help="覆盖两个账号的API地址，例如本地的批处理测试服务")
+    parser.add_argument("--collect-window", type=float, default=2.0, help="收集请求的时间窗口（秒），窗口内的请求合并为一个批次")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="轮询批次状态的间隔（秒）")
+    args = parser.parse_args()
+    if args.resume and not os.path.isdir(checkpoint_folder(args.checkpoint_dir, args.jobs, args.resume)):
+        parser.error(f"找不到运行 {args.resume} 的检查点：{checkpoint_folder(args.checkpoint_dir, args.jobs, args.resume)}")
+    run_id = args.resume or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    asyncio.run(run_jobs(
+        args.jobs,
+        args.output,
+        args.checkpoint_dir,
+        run_id,
+        base_url=args.base_url,
+        collect_window=args.collect_window,
+        poll_interval=args.poll_interval
+    ))
@@ -0,0 +1,115 @@
+import argparse
+import datetime
+from config import OUTPUT_DIR
+from utils.text_utils import parse_score
+from utils.session_catalog import (
+    list_sessions,
+    aggregate_by_model,
+    rebuild_index,
+    compress_session,
+    prune_sessions,
+)
+
+def _add_filter_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--keyword", help="按问题或标题关键词过滤")
+    parser.add_argument("--since", help="起始日期（含），如 2025-02-01")
+    parser.add_argument("--until", help="截止日期（不含），如 2025-03-01")
+    parser.add_argument("--min-score", type=float, help="最低评分")
+    parser.add_argument("--max-score", type=float, help="最高评分")
+    parser.add_argument("--model", help="只统计使用过该模型的会话")
+
+def _filters(args) -> dict:
+    return {
+        "keyword": args.keyword,
+        "since": args.since,
+        "until": args.until,
+        "min_score": args.min_score,
+        "max_score": args.max_score,
+        "model": args.model,
+    }
+
+def _format_score(score) -> str:
+    # 旧索引中可能存有文本形式的评分（如 "8/10"），统一解析后再显示
+    score = parse_score(score)
+    return "-" if score is None else f"{score:g}"
+
+def cmd_list(args):
+    sessions = list_sessions(args.root, limit=args.limit, order_by=args.order_by, **_filters(args))
+    for s in sessions:
+        archived = " [已归档]" if s["archived"] else ""
+        estimated = f" [优化后估算 {_format_score(s['estimated_score'])}]" if s["estimated_score"] is not None else ""
+        print(f"{s['created_at'] or '-':<20} 评分 {_format_score(s['score']):>4}  "
+              f"调用 {s['api_calls'] or 0:>4}  {s['session_id']}{archived}{estimated}")
+    print(f"共 {len(sessions)} 个会话")
+
+def cmd_stats(args):
+    rows = aggregate_by_model(args.root, **_filters(args))
+    print(f"{'模型':<36}{'会话':>6}{'平均评分':>10}{'调用':>8}{'输入tokens':>12}{'输出tokens':>12}{'平均耗时(s)':>12}")
+    for r in rows:
+        mean_score = "-" if r["mean_score"] is None else f"{r['mean_score']:.2f}"
+        mean_latency = "-" if r["mean_latency"] is None else f"{r['mean_latency']:.2f}"
+        print(f"{r['model']:<36}{r['sessions']:>6}{mean_score:>10}{r['calls']:>8}"
+              f"{r['prompt_tokens']:>12}{r['completion_tokens']:>12}{mean_latency:>12}")
+
+def _older_sessions(args) -> list:
+    until = (datetime.date.today() - datetime.timedelta(days=args.older_than)).isoformat()
+    filters = dict(_filters(args), until=min(filter(None, [args.until, until])))
+    return list_sessions(args.root, **filters)
+
+def cmd_compress(args):
+    targets = [s for s in _older_sessions(args) if not s["archived"]]
+    for s in targets:
+        if args.yes:
+            print("已压缩：", compress_session(s["session_id"], args.root))
+        else:
+            print("将压缩：", s["session_id"])
+    if not args.yes:
+        print(f"共 {len(targets)} 个会话，加 --yes 执行")
+
+def cmd_prune(args):
+    targets = [s["session_id"] for s in _older_sessions(args)]
+    for session_id in targets:
+        print("删除：" if args.yes else "将删除：", session_id)
+    if args.yes:
+        print(f"已删除 {prune_sessions(targets, args.root)} 个会话")
+    else:
+        print(f"共 {len(targets)} 个会话，加 --yes 执行")
+
+def cmd_rebuild(args):
+    count = rebuild_index(args.root, backfill=not args.no_backfill)
+    print(f"索引重建完成，共 {count} 个会话")
+
+def main():
+    parser = argparse.ArgumentParser(description="会话目录索引：查询、统计、压缩与清理历史会话")
+    parser.add_argument("--root", default=OUTPUT_DIR, help="会话根目录（默认为 OUTPUT_DIR）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("list", help="列出会话")
+    _add_filter_args(p)
+    p.add_argument("--limit", type=int, default=50)
+    p.add_argument("--order-by", default="created_at", choices=["created_at", "score", "duration", "api_calls"])
+    p.set_defaults(func=cmd_list)
+
+    p = subparsers.add_parser("stats", help="按模型聚合平均评分、token 与耗时")
+    _add_filter_args(p)
+    p.set_defaults(func=cmd_stats)
+
+    for name, func, help_text in (
+        ("compress", cmd_compress, "将旧会话打包为 tar.gz"),
+        ("prune", cmd_prune, "删除旧会话"),
+    ):
+        p = subparsers.add_parser(name, help=help_text)
+        _add_filter_args(p)
+        p.add_argument("--older-than", type=int, default=30, help="只处理早于 N 天的会话")
+        p.add_argument("--yes", action="store_true", help="确认执行（默认只预览）")
+        p.set_defaults(func=func)
+
+    p = subparsers.add_parser("rebuild", help="扫描目录重建索引，并为旧会话补写清单")
+    p.add_argument("--no-backfill", action="store_true", help="跳过没有清单的旧会话")
+    p.set_defaults(func=cmd_rebuild)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
+import argparse
 import asyncio
 import datetime
 import re
 from workflow import AutoQASystem
+from utils.metrics import start_metrics_server, run_progress_view
 
-async def main():
+async def main(metrics_port: int = None, show_progress: bool = False):
     question = input("想讨论什么问题呢：")
     cognitive = input("当前对这问题有着什么样的认识：")
     goal = input("通过阅读你想达到什么样的目的：")
@@ -11,17 +13,32 @@ async def main():
     custom_branch = ""
     if custom_option.strip().lower() in ["y", "yes"]:
         custom_branch = input("请输入自定义分支：")
-    
+
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     safe_title = re.sub(r"\W+", "_", question).strip("_")
     session_folder = f"output/{safe_title}_{timestamp}"
     print("历史记录将存储在：", session_folder)
-    
-    system = AutoQASystem(output_dir=session_folder)
-    result = await system.execute_workflow(question, cognitive, goal, custom_branch)
-    
+
+    # 可选的监控：Prometheus 指标服务与终端进度行
+    metrics_server = await start_metrics_server(metrics_port) if metrics_port else None
+    progress_task = asyncio.create_task(run_progress_view()) if show_progress else None
+
+    try:
+        system = AutoQASystem(output_dir=session_folder)
+        result = await system.execute_workflow(question, cognitive, goal, custom_branch)
+    finally:
+        if progress_task:
+            progress_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+
     print("\n最终报告：\n", result.get("报告内容", ""))
     print("\n质量评估：\n", result.get("质量评估", ""))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics-port", type=int, help="在本地该端口的 /metrics 暴露 Prometheus 指标")
+    parser.add_argument("--progress", action="store_true", help="每隔几秒在终端输出一行运行进度")
+    args = parser.parse_args()
+    asyncio.run(main(args.metrics_port, args.progress))
@@ -1,58 +1,105 @@
 import asyncio
+import contextlib
+import time
 from openai import AsyncOpenAI  # 关键词: OpenAI, 异步API, SDK
 from config import API_BASE_URL, API_KEY, RESEARCH_API_BASE_URL, RESEARCH_API_KEY  # 关键词: 配置导入, API设置
+from utils.metrics import metrics
+from utils.events import echo, emit, UsageUpdated
+from utils.session_catalog import record_call_usage
+
+# 添加系统消息，要求模型输出必须以 "<think>\n嗯" 开始
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "Initiate your response with \"<think>\\n嗯\" at the beginning of every output."
+}
 
 class APIClient:
     total_api_calls = 0  # 类变量用于记录整个过程中的API调用次数
     # 设置全局并发限制：所有API调用全局最多同时进行3个请求
     global_semaphore = asyncio.Semaphore(3)
     
-    def __init__(self, base_url=API_BASE_URL, api_key=API_KEY):
+    def __init__(self, base_url=API_BASE_URL, api_key=API_KEY, account: str = "main", rate_limiter=None):
         # 关键词: 初始化, API客户端设置, 配置读取
+        self.account = account  # 监控指标中区分账号的标签
+        # 可选的跨进程速率限制（见 utils.task_queue.RateLimiter），只作用于本客户端实例
+        self.rate_limiter = rate_limiter
         self.client = AsyncOpenAI(
             base_url=base_url,
             api_key=api_key
         )
     
-    async def call_model(self, model: str, messages: list, temp: float = 0.7, max_tokens: int = 4096) -> str:
+    @staticmethod
+    def _record_usage(model: str, prompt_tokens: int, completion_tokens: int, latency: float,
+                      words: int = 0, usage: dict = None) -> None:
+        """把单次成功调用的 token、耗时与返回字数计入当前会话；如传入 usage 字典则同时写回本次用量"""
+        record_call_usage(model, prompt_tokens, completion_tokens, latency, words)
+        emit(UsageUpdated(model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                          latency=latency, total_calls=APIClient.total_api_calls))
+        if usage is not None:
+            usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + prompt_tokens
+            usage["completion_tokens"] = usage.get("completion_tokens", 0) + completion_tokens
+            usage["latency"] = usage.get("latency", 0.0) + latency
+
+    def _record_metrics(self, model: str, response, latency: float) -> None:
+        """向监控指标上报一次成功调用的耗时与 token 数"""
+        response_usage = getattr(response, "usage", None)
+        metrics.inc("aipro_api_calls_total", model=model, account=self.account, status="success")
+        metrics.observe("aipro_api_latency_seconds", latency, model=model)
+        metrics.inc("aipro_tokens_total", getattr(response_usage, "prompt_tokens", 0) or 0, model=model, kind="prompt")
+        metrics.inc("aipro_tokens_total", getattr(response_usage, "completion_tokens", 0) or 0, model=model, kind="completion")
+
+    async def call_model(self, model: str, messages: list, temp: float = 0.7, max_tokens: int = 4096, usage: dict = None) -> str:
         """封装模型调用，包含重试机制
            在首个消息中添加指令，要求模型在回答前加入思考流程
+           usage: 可选字典，调用成功后累加本次的 prompt_tokens/completion_tokens/latency
            关键词: API调用, 重试逻辑, 异步方法, 聊天完成, 系统指令
         """
-        # 添加系统消息，要求模型输出必须以 "<think>\n嗯" 开始
-        system_message = {
-            "role": "system",
-            "content": "Initiate your response with \"<think>\\n嗯\" at the beginning of every output."
-        }
         # 将系统消息放在消息列表最前面
-        messages_with_instruction = [system_message] + messages
+        messages_with_instruction = [SYSTEM_MESSAGE] + messages
 
         max_retries = 3  # 关键词: 最大重试次数, 计数器
         for attempt in range(max_retries):
             try:
-                async with APIClient.global_semaphore:
+                async with metrics.track_semaphore(APIClient.global_semaphore, account=self.account):
                     # 每次实际调用API时，计数器加1，并输出调用信息
                     APIClient.total_api_calls += 1
-                    print(f"[API调用] 第 {APIClient.total_api_calls} 次调用. 模型: {model}, 尝试次数: {attempt + 1}")
+                    echo(f"[API调用] 第 {APIClient.total_api_calls} 次调用. 模型: {model}, 尝试次数: {attempt + 1}")
                     
                     # 关键词: 模型请求, 响应解析, 实现chat完成逻辑
-                    response = await self.client.chat.completions.create(
-                        model=model,
-                        messages=messages_with_instruction,
-                        temperature=temp,
-                        top_p=0.8,       # 关键词: top_p, 采样参数
-                        max_tokens=max_tokens
-                    )
+                    limit = self.rate_limiter.limit() if self.rate_limiter else contextlib.nullcontext()
+                    async with limit:
+                        start_time = time.monotonic()
+                        response = await self.client.chat.completions.create(
+                            model=model,
+                            messages=messages_with_instruction,
+                            temperature=temp,
+                            top_p=0.8,       # 关键词: top_p, 采样参数
+                            max_tokens=max_tokens
+                        )
+                    latency = time.monotonic() - start_time
                     # 关键词: 成功返回, 解析响应内容
-                    return response.choices[0].message.content
+                    content = response.choices[0].message.content
+                    response_usage = getattr(response, "usage", None)
+                    APIClient._record_usage(
+                        model,
+                        getattr(response_usage, "prompt_tokens", 0) or 0,
+                        getattr(response_usage, "completion_tokens", 0) or 0,
+                        latency,
+                        len(content or ""),
+                        usage
+                    )
+                    self._record_metrics(model, response, latency)
+                    return content
             except Exception as e:
                 # 关键词: 异常处理, 错误, 指数退避
+                metrics.inc("aipro_api_calls_total", model=model, account=self.account, status="error")
                 if attempt == max_retries - 1:
                     raise  # 关键词: 最终失败, 程序终止
+                metrics.inc("aipro_api_retries_total", model=model, account=self.account)
                 await asyncio.sleep(2**attempt)  # 关键词: 重试延时, 指数增长
         return ""  # 关键词: 默认返回, 空字符串
 
 class ResearchAPIClient(APIClient):
     """专门用于研究阶段的 API 客户端，在初始化时使用研究专用的 API 配置"""
-    def __init__(self):
-        super().__init__(RESEARCH_API_BASE_URL, RESEARCH_API_KEY)
\ No newline at end of file
+    def __init__(self, rate_limiter=None):
+        super().__init__(RESEARCH_API_BASE_URL, RESEARCH_API_KEY, account="research", rate_limiter=rate_limiter)
\ No newline at end of file
@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+from config import API_BASE_URL, API_KEY, RESEARCH_API_BASE_URL, RESEARCH_API_KEY
+from modules.api_client import APIClient, SYSTEM_MESSAGE
+from utils.events import echo
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 批处理任务的终止状态
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchAPIClient(APIClient):
+    """批处理 API 客户端：与 APIClient 接口相同，但不逐个请求，而是把一段时间内的请求合并提交到
+    OpenAI 风格的 /v1/batches 接口，轮询完成后再把结果分发回各个 call_model 调用。
+
+    各阶段本来就用 asyncio.gather 并发发起请求，因此同一阶段（以及同时运行的多个任务）的请求
+    会在 collect_window 秒内被收集到同一个批次中，Decomposer/Researcher/Evaluator 的代码无需改动。
+
+    检查点：每个请求按内容哈希把结果追加到 batch_results_<账号>.jsonl，已提交但未完成的批次记录在
+    batch_checkpoint_<账号>.json 中（每个批次提交或结束时重写，只包含进行中的批次）。中断后用同一 checkpoint_dir
+    重新运行时，已完成的阶段直接从结果文件返回，未完成的批次继续轮询而不会重复提交。
+    checkpoint_dir 应只属于一次运行，否则内容相同的请求会直接返回以前的结果。
+    """
+
+    def __init__(self, checkpoint_dir: str, base_url=API_BASE_URL, api_key=API_KEY, account: str = "main",
+                 collect_window: float = 2.0, poll_interval: float = 30.0, max_batch_size: int = 50000,
+                 max_retries: int = 2):
+        super().__init__(base_url, api_key, account)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(checkpoint_dir, f"batch_checkpoint_{account}.json")
+        self.results_path = os.path.join(checkpoint_dir, f"batch_results_{account}.jsonl")
+        self.collect_window = collect_window
+        self.poll_interval = poll_interval
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.checkpoint = self._load_checkpoint()
+        self.results = self._load_results()  # 请求哈希 -> 结果
+        self._bodies = {}  # 请求哈希 -> 请求体，重试时重新提交
+        self._attempts = {}  # 请求哈希 -> 已重试次数
+        self._pending = {}  # 请求哈希 -> 请求体，等待提交
+        self._futures = {}  # 请求哈希 -> Future，等待结果
+        self._polling = {}  # 批次ID -> 轮询任务
+        self._submitting = set()  # 进行中的提交任务；asyncio 只弱引用任务，需要在这里持有
+        self._flush_handle = None
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {"batches": {}}
+
+    def _load_results(self) -> dict:
+        results = {}
+        try:
+            with open(self.results_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 写入中途崩溃留下的不完整行
+                    results[record.pop("key")] = record
+        except OSError:
+            pass
+        return results
+
+    def _append_results(self, results: dict) -> None:
+        """把新完成的结果追加到结果文件，已有的结果不会被重写"""
+        if not results:
+            return
+        with open(self.results_path, "a", encoding="utf-8") as f:
+            for key, result in results.items():
+                f.write(json.dumps({"key": key, **result}, ensure_ascii=False) + "\n")
+
+    def _save_checkpoint(self) -> None:
+        """原子写入进行中的批次，避免中途崩溃留下损坏的文件"""
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    async def call_model(self, model: str, messages: list, temp: float = 0.7, max_tokens: int = 4096, usage: dict = None) -> str:
+        """与 APIClient.call_model 相同的签名；请求会被合并进批次，结果返回前会一直等待
+
+        用量在调用方自己的上下文中记录，同一批次中不同会话的请求各自计入所属会话；
+        从检查点恢复的结果同样计入，使中断后继续的会话清单反映整份报告的用量。
+        """
+        started = time.monotonic()
+        body = {
+            "model": model,
+            "messages": [SYSTEM_MESSAGE] + messages,
+            "temperature": temp,
+            "top_p": 0.8,
+            "max_tokens": max_tokens,
+        }
+        key = hashlib.sha256(json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        cached = self.results.get(key)
+        if cached is None:
+            self._bodies[key] = body
+            if key not in self._futures:
+                self._futures[key] = asyncio.get_running_loop().create_future()
+                batch_id = next((b for b, keys in self.checkpoint["batches"].items() if key in keys), None)
+                if batch_id:
+                    # 上次运行已提交但未完成的批次：继续轮询，不重复提交
+                    self._ensure_polling(batch_id)
+                else:
+                    self._enqueue(key)
+            cached = await asyncio.shield(self._futures[key])
+        APIClient._record_usage(model, cached["prompt_tokens"], cached["completion_tokens"],
+                                time.monotonic() - started, len(cached["content"] or ""), usage)
+        return cached["content"]
+
+    def _enqueue(self, key: str) -> None:
+        self._pending[key] = self._bodies[key]
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+            return
+        # 去抖：每来一个新请求就重新计时，collect_window 秒内没有新请求时提交
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(self.collect_window, self._flush)
+
+    def _flush(self) -> None:
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        items, self._pending = self._pending, {}
+        task = asyncio.get_running_loop().create_task(self._submit(items))
+        self._submitting.add(task)
+        task.add_done_callback(self._submitting.discard)
+
+    async def _submit(self, items: dict) -> None:
+        lines = [
+            json.dumps({"custom_id": key, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False)
+            for key, body in items.items()
+        ]
+        try:
+            input_file = await self.client.files.create(
+                file=(f"batch_{int(time.time())}.jsonl", ("\n".join(lines) + "\n").encode("utf-8")),
+                purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window="24h"
+            )
+        except Exception as e:
+            self._retry_or_fail({key: f"批次提交失败：{e!r}" for key in items})
+            return
+        echo(f"[批处理] 已提交批次 {batch.id}（{self.account}），共 {len(items)} 个请求")
+        self.checkpoint["batches"][batch.id] = list(items)
+        self._save_checkpoint()
+        self._ensure_polling(batch.id)
+
+    def _ensure_polling(self, batch_id: str) -> None:
+        if batch_id not in self._polling:
+            self._polling[batch_id] = asyncio.get_running_loop().create_task(self._poll(batch_id))
+
+    async def _poll(self, batch_id: str) -> None:
+        """轮询批次直到结束，解析输出与错误文件，把结果分发给等待的调用"""
+        started = time.monotonic()
+        keys = self.checkpoint["batches"].get(batch_id, [])
+        collected, errors = {}, {}
+        try:
+            while True:
+                batch = await self.client.batches.retrieve(batch_id)
+                if batch.status in FINAL_STATUSES:
+                    break
+                await asyncio.sleep(self.poll_interval)
+            echo(f"[批处理] 批次 {batch_id} 结束，状态：{batch.status}")
+
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                content = await self.client.files.content(file_id)
+                for line in content.text.splitlines():
+                    if line.strip():
+                        self._collect_line(json.loads(line), collected, errors, time.monotonic() - started)
+        except Exception as e:
+            errors = {key: f"批次 {batch_id} 轮询失败：{e!r}" for key in keys}
+        finally:
+            self._polling.pop(batch_id, None)
+
+        # 先追加结果再移除批次记录，任一步骤后中断都不会丢失已完成的结果
+        self._append_results(collected)
+        self.results.update(collected)
+        self.checkpoint["batches"].pop(batch_id, None)
+        missing = {key: errors.get(key, f"批次 {batch_id} 中没有该请求的结果") for key in keys
+                   if key not in self.results}
+        self._save_checkpoint()
+        for key in keys:
+            if key in self.results and key in self._futures and not self._futures[key].done():
+                self._futures.pop(key).set_result(self.results[key])
+        self._retry_or_fail(missing)
+
+    def _collect_line(self, record: dict, collected: dict, errors: dict, latency: float) -> None:
+        """解析输出文件中的一行：成功的放入 collected，失败的记录错误信息"""
+        key = record.get("custom_id")
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") == 200 and body.get("choices"):
+            model = body.get("model", "")
+            response_usage = body.get("usage") or {}
+            prompt_tokens = response_usage.get("prompt_tokens", 0)
+            completion_tokens = response_usage.get("completion_tokens", 0)
+            APIClient.total_api_calls += 1
+            usage_ns = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+            # 这里运行在轮询任务中，只更新进程级的监控指标；会话用量由各调用方在 call_model 中记录
+            self._record_metrics(model, usage_ns, latency)
+            collected[key] = {
+                "content": body["choices"][0]["message"]["content"],
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+            }
+        else:
+            errors[key] = json.dumps(record.get("error") or body.get("error") or response, ensure_ascii=False)
+
+    def _retry_or_fail(self, missing: dict) -> None:
+        """失败的请求在 max_retries 次以内放入下一个批次重试，否则让对应的 call_model 抛出异常"""
+        for key, error in missing.items():
+            future = self._futures.get(key)
+            if future is None or future.done():
+                continue
+            if self._attempts.get(key, 0) < self.max_retries and key in self._bodies:
+                self._attempts[key] = self._attempts.get(key, 0) + 1
+                echo(f"[批处理] 请求失败，第 {self._attempts[key]} 次重试：{error}")
+                self._enqueue(key)
+            else:
+                self._futures.pop(key)
+                future.set_exception(RuntimeError(f"批处理请求失败：{error}"))
+
+
+def create_batch_clients(checkpoint_dir: str, base_url: str = None, api_key: str = None, **options) -> tuple:
+    """创建主账号与研究账号的批处理客户端，可传给 AutoQASystem(batch_clients=...)。
+    多个工作流共用同一对客户端时，它们同一阶段的请求会合并到同一个批次中。
+    base_url/api_key 用于让两个账号都指向同一个服务，例如本地的批处理测试服务。"""
+    return (
+        BatchAPIClient(checkpoint_dir, base_url or API_BASE_URL, api_key or API_KEY, "main", **options),
+        BatchAPIClient(checkpoint_dir, base_url or RESEARCH_API_BASE_URL, api_key or RESEARCH_API_KEY, "research", **options),
+    )
@@ -1,12 +1,14 @@
 import asyncio
 import json
+import math
 import re
 from typing import List, Dict, Any
 from config import WORKFLOW_STAGES
-from modules.api_client import APIClient
+from modules.api_client import APIClient, ResearchAPIClient
 from utils.file_utils import append_text
 from utils.text_utils import extract_json
 from utils.resource_tracker import update_resource_usage
+from utils.events import echo
 
 # 尝试修复 JSON 字符串中字段值缺少引号的问题的函数可以保留，以备最终输出时使用
 def fix_invalid_json(json_str: str) -> str:
@@ -22,14 +24,35 @@ def fix_invalid_json(json_str: str) -> str:
     return pattern.sub(replacer, json_str)
 
 class Decomposer:
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, num_generators: int = 3, group_size: int = 20,
+                 keep_per_group: int = 10, final_candidates: int = 30):
+        """
+        Args:
+            output_dir: 输出目录
+            num_generators: 阶段1并行生成标题的AI数量
+            group_size: 阶段2淘汰赛中每个评分AI一次审阅的标题数
+            keep_per_group: 每组保留的标题数，不超过 group_size 的一半，以保证每轮都能明显缩减
+            final_candidates: 进入阶段3最终选择的候选标题上限
+        """
+        if not 0 < keep_per_group * 2 <= group_size:
+            raise ValueError(f"keep_per_group 必须大于0且不超过 group_size 的一半，当前为 {keep_per_group}/{group_size}")
+        if final_candidates < keep_per_group:
+            raise ValueError(f"final_candidates 不能小于 keep_per_group，当前为 {final_candidates}/{keep_per_group}")
         self.output_dir = output_dir
         self.api_client = APIClient()
-
-    async def _call_ai_for_json_list(self, prompt: str, attempt_msg: str) -> List[str]:
+        self.research_api_client = ResearchAPIClient()
+        # 生成与评分任务轮流分配给两个账号，以提高并行效率
+        self.clients = [self.api_client, self.research_api_client]
+        self.num_generators = num_generators
+        self.group_size = group_size
+        self.keep_per_group = keep_per_group
+        self.final_candidates = final_candidates
+
+    async def _call_ai_for_json_list(self, prompt: str, attempt_msg: str, client: APIClient = None) -> List[str]:
         """调用AI并期望返回一个JSON字符串列表"""
-        print(attempt_msg)
-        result = await self.api_client.call_model(
+        echo(attempt_msg)
+        client = client or self.api_client
+        result = await client.call_model(
             model=WORKFLOW_STAGES['decomposition'], # 可以考虑为不同阶段设置不同模型或参数
             messages=[{"role": "user", "content": prompt}],
             temp=0.7 # 对于生成和选择阶段，可以适当调整温度
@@ -48,13 +71,13 @@ class Decomposer:
             try:
                 return json.loads(json_str)
             except json.JSONDecodeError:
-                print(f"警告：AI返回的JSON列表解析失败，尝试作为纯文本处理。内容: {json_str}")
+                echo(f"警告：AI返回的JSON列表解析失败，尝试作为纯文本处理。内容: {json_str}")
                 # 如果解析失败，尝试基于换行符分割，并去除空行和多余引号
                 # 这是一个简化的回退逻辑，可能需要根据实际AI输出调整
                 return [line.strip().strip('"').strip("'") for line in json_str.split('\n') if line.strip()]
         else:
             # 如果无法提取JSON数组，则按行分割返回的文本作为最后的尝试
-            print(f"警告：AI未返回预期的JSON列表格式。尝试按行解析。内容: {result}")
+            echo(f"警告：AI未返回预期的JSON列表格式。尝试按行解析。内容: {result}")
             return [line.strip() for line in result.split('\n') if line.strip()]
 
     async def _generate_initial_titles(self, question: str, cognitive: str, goal: str, generator_id: int) -> List[str]:
@@ -70,12 +93,13 @@ class Decomposer:
 ["标题1", "标题2", "标题3", ...]
 不要包含任何其他解释性文字或标记。
 """
-        return await self._call_ai_for_json_list(prompt, f"生成初始标题 (生成器 {generator_id+1})")
+        client = self.clients[generator_id % len(self.clients)]
+        return await self._call_ai_for_json_list(prompt, f"生成初始标题 (生成器 {generator_id+1})", client)
 
-    async def _score_and_select_titles(self, titles_to_score: List[str], question: str, cognitive: str, goal: str, scorer_id: int) -> List[str]:
-        """第二阶段：单个AI从给定列表中评分并选出10个标题"""
+    async def _score_and_select_titles(self, titles_to_score: List[str], question: str, cognitive: str, goal: str, scorer_id: int, keep: int = 10, round_index: int = 1) -> List[str]:
+        """第二阶段：单个AI从给定列表中评分并选出 keep 个标题"""
         titles_str = "\n".join([f"- \"{t}\"" for t in titles_to_score])
-        prompt = f"""作为问题分解的第 {scorer_id+1} 号AI评分员，请从以下候选标题列表中，选出最多10个与主要问题、用户知识和目标最相关、最有价值且不重复的标题。
+        prompt = f"""作为问题分解的第 {scorer_id+1} 号AI评分员，请从以下候选标题列表中，选出最多{keep}个与主要问题、用户知识和目标最相关、最有价值且不重复的标题。
 请仔细评估每个标题的质量和相关性。
 
 原始问题："{question}"
@@ -85,18 +109,66 @@ class Decomposer:
 候选标题列表：
 {titles_str}
 
-请严格以JSON字符串列表的格式返回你选出的10个标题，例如：
+请严格以JSON字符串列表的格式返回你选出的{keep}个标题，例如：
 ["选中的标题A", "选中的标题B", ...]
 不要包含任何其他解释性文字或标记。
 """
-        return await self._call_ai_for_json_list(prompt, f"评分和选择标题 (评分器 {scorer_id+1})")
+        client = self.clients[scorer_id % len(self.clients)]
+        return await self._call_ai_for_json_list(prompt, f"评分和选择标题 (第 {round_index} 轮, 评分器 {scorer_id+1})", client)
+
+    @staticmethod
+    def _unique_titles(titles: list) -> List[str]:
+        """去重并过滤非字符串和空标题，保持首次出现的顺序"""
+        seen_titles = set()
+        unique_titles = []
+        for title in titles:
+            if isinstance(title, str) and title.strip() and title not in seen_titles:
+                unique_titles.append(title)
+                seen_titles.add(title)
+        return unique_titles
+
+    async def _tournament_select(self, titles: List[str], question: str, cognitive: str, goal: str) -> List[str]:
+        """
+        多轮淘汰赛：每轮把候选标题分成若干小组，各组由评分AI并行选出 keep_per_group 个，
+        直到候选数不超过 final_candidates。每轮候选数大约减半，轮数约为 log(标题数)，
+        因此加宽生成只增加并行度，而不会增加串行延迟或最终选择的提示长度。
+        """
+        candidates = titles
+        round_index = 0
+        while len(candidates) > self.final_candidates:
+            round_index += 1
+            num_groups = math.ceil(len(candidates) / self.group_size)
+            # 交错分组，让每组都混合来自不同生成器的标题
+            groups = [candidates[i::num_groups] for i in range(num_groups)]
+            echo(f"第 {round_index} 轮：{len(candidates)} 个候选标题分为 {num_groups} 组并行评分...")
+            results = await asyncio.gather(*[
+                self._score_and_select_titles(group, question, cognitive, goal, i, self.keep_per_group, round_index)
+                for i, group in enumerate(groups)
+            ])
+
+            selected = []
+            for group, title_list in zip(groups, results):
+                if not isinstance(title_list, list):
+                    echo(f"警告：评分器返回了非列表类型: {type(title_list)}")
+                    title_list = []
+                keep = min(self.keep_per_group, len(group))
+                picked = self._unique_titles(title_list)[:keep]
+                # 评分失败的小组保留其前 keep 个标题，避免整组被淘汰
+                selected.extend(picked or group[:keep])
+            selected = self._unique_titles(selected)
+            if len(selected) >= len(candidates):
+                # 理论上不会发生，防御性截断以免死循环
+                selected = selected[:self.final_candidates]
+            candidates = selected
+            append_text("decomposer_history.txt", f"--- 阶段2 第{round_index}轮 晋级标题 ---\n{json.dumps(candidates, ensure_ascii=False, indent=2)}\n--- End ---", output_dir=self.output_dir)
+        return candidates
 
     async def _finalize_selection_and_add_reasons(self, final_candidate_titles: List[str], question: str, cognitive: str, goal: str, custom_branch: str) -> Dict[str, List[Dict[str, str]]]:
-        """第三阶段：最后一个AI从30个标题中提取最多10个，并添加理由，形成最终JSON"""
+        """第三阶段：最后一个AI从淘汰赛晋级的候选标题中提取最多10个，并添加理由，形成最终JSON"""
         titles_str = "\n".join([f"- \"{t}\"" for t in final_candidate_titles])
         custom_branch_info = f'请额外考虑并优先纳入这个自定义分支（如果它尚未在列表中且有意义）："{custom_branch}"' if custom_branch else "没有自定义分支。"
 
-        prompt = f"""作为问题分解的最终决策AI，请从以下大约30个精选候选标题中，选出最终的、不超过10个子问题。
+        prompt = f"""作为问题分解的最终决策AI，请从以下{len(final_candidate_titles)}个精选候选标题中，选出最终的、不超过10个子问题。
 这些子问题应能全面且有逻辑地覆盖原始问题，并考虑用户的知识水平和学习目标。
 请确保选出的子问题是从最简单或最基础的开始，逐步深入到更复杂的方面。
 为每个选定的子问题提供一个简短的理由，解释为什么选择该分支。
@@ -117,7 +189,7 @@ class Decomposer:
   ]
 }}
 """
-        print("进行最终选择并添加理由")
+        echo("进行最终选择并添加理由")
         result_str = await self.api_client.call_model(
             model=WORKFLOW_STAGES['decomposition'], # 可以考虑为最终阶段设置不同模型或参数
             messages=[{"role": "user", "content": prompt}],
@@ -129,7 +201,7 @@ class Decomposer:
         # 提取最终的JSON对象
         json_output_str = extract_json(result_str)
         if not json_output_str:
-            print("错误：最终选择AI未能返回有效的JSON结构。原始返回：", result_str)
+            echo("错误：最终选择AI未能返回有效的JSON结构。原始返回：", result_str)
             # 尝试构建一个空的有效结构，避免整个流程崩溃
             return {"子问题": []}
 
@@ -143,26 +215,26 @@ class Decomposer:
         try:
             final_decomposition = json.loads(json_output_str)
             if "子问题" not in final_decomposition or not isinstance(final_decomposition["子问题"], list):
-                print(f"错误：最终JSON结构不符合预期（缺少'子问题'列表）。内容: {json_output_str}")
+                echo(f"错误：最终JSON结构不符合预期（缺少'子问题'列表）。内容: {json_output_str}")
                 return {"子问题": []}
             return final_decomposition
         except json.JSONDecodeError as e:
-            print(f"错误：最终JSON解析失败。修复尝试后的JSON文本：{json_output_str}。错误：{e}")
+            echo(f"错误：最终JSON解析失败。修复尝试后的JSON文本：{json_output_str}。错误：{e}")
             return {"子问题": []} # 返回一个空的有效结构
 
     async def decompose_question(self, question: str, cognitive: str, goal: str, custom_branch: str = "") -> dict:
         """
         根据用户信息生成文章分支（子问题），采用多阶段AI协作机制。
-        阶段1: 3个AI分别生成约20个标题。
-        阶段2: 3个AI分别从上述生成的标题中挑选10个。
-        阶段3: 1个AI从阶段2选出的30个标题中最终选择不超过10个，并添加理由。
+        阶段1: num_generators 个AI分别生成约20个标题。
+        阶段2: 多轮淘汰赛，每轮小组并行评分并保留 keep_per_group 个，直到不超过 final_candidates 个。
+        阶段3: 1个AI从阶段2晋级的标题中最终选择不超过10个，并添加理由。
         """
-        print("开始多阶段问题分解...")
+        echo("开始多阶段问题分解...")
 
         # 阶段1: 并行生成初始标题
-        print("\n阶段1：生成初始候选标题...")
+        echo("\n阶段1：生成初始候选标题...")
         generation_tasks = [
-            self._generate_initial_titles(question, cognitive, goal, i) for i in range(3)
+            self._generate_initial_titles(question, cognitive, goal, i) for i in range(self.num_generators)
         ]
         results_stage1 = await asyncio.gather(*generation_tasks)
         
@@ -171,75 +243,32 @@ class Decomposer:
             if isinstance(title_list, list):
                 all_initial_titles.extend(title_list)
             else:
-                print(f"警告：生成器返回了非列表类型: {type(title_list)}")
+                echo(f"警告：生成器返回了非列表类型: {type(title_list)}")
         
         # 去重，保持一定的顺序性（基于首次出现）
-        seen_titles = set()
-        unique_initial_titles = []
-        for title in all_initial_titles:
-            if isinstance(title, str) and title.strip() and title not in seen_titles:
-                unique_initial_titles.append(title)
-                seen_titles.add(title)
+        unique_initial_titles = self._unique_titles(all_initial_titles)
         
         if not unique_initial_titles:
-            print("错误：阶段1未能生成任何有效标题。返回空分解。")
+            echo("错误：阶段1未能生成任何有效标题。返回空分解。")
             return {"子问题": []}
-        print(f"阶段1完成：共生成 {len(unique_initial_titles)} 个不重复的初始标题。")
+        echo(f"阶段1完成：共生成 {len(unique_initial_titles)} 个不重复的初始标题。")
         append_text("decomposer_history.txt", f"--- 阶段1 不重复初始标题 ---\n{json.dumps(unique_initial_titles, ensure_ascii=False, indent=2)}\n--- End ---", output_dir=self.output_dir)
 
 
-        # 阶段2: 并行评分和选择标题
-        # 将标题大致均分给3个评分AI
-        print("\n阶段2：评分和筛选候选标题...")
-        num_scorers = 3
-        chunk_size = (len(unique_initial_titles) + num_scorers - 1) // num_scorers # 确保能分完
-        
-        scoring_tasks = []
-        for i in range(num_scorers):
-            start_index = i * chunk_size
-            end_index = min((i + 1) * chunk_size, len(unique_initial_titles))
-            if start_index < end_index: # 确保块内有内容
-                titles_chunk = unique_initial_titles[start_index:end_index]
-                scoring_tasks.append(
-                    self._score_and_select_titles(titles_chunk, question, cognitive, goal, i)
-                )
-        
-        results_stage2 = await asyncio.gather(*scoring_tasks)
-        
-        all_selected_titles_stage2 = []
-        for title_list in results_stage2:
-            if isinstance(title_list, list):
-                all_selected_titles_stage2.extend(title_list)
-            else:
-                print(f"警告：评分器返回了非列表类型: {type(title_list)}")
-
-        seen_titles_stage2 = set()
-        unique_selected_titles_stage2 = []
-        for title in all_selected_titles_stage2:
-             if isinstance(title, str) and title.strip() and title not in seen_titles_stage2:
-                unique_selected_titles_stage2.append(title)
-                seen_titles_stage2.add(title)
-
-        if not unique_selected_titles_stage2:
-            print("错误：阶段2未能筛选出任何有效标题。将尝试使用阶段1的全部标题进行最终选择。")
-            # 如果阶段2没有选出任何标题，作为回退，直接用阶段1的全部不重复标题给最终选择AI
-            # 但这可能会超出最终选择AI的处理能力或提示长度限制，需要注意
-            if not unique_initial_titles: # 再次检查，如果连初始标题都没有，就真没办法了
-                 print("错误：阶段1和阶段2均无有效标题。返回空分解。")
-                 return {"子问题": []}
-            unique_selected_titles_stage2 = unique_initial_titles[:100] # 限制数量，避免过长
-            print(f"警告：阶段2无输出，回退到使用阶段1的前{len(unique_selected_titles_stage2)}个标题进行最终选择。")
-
-        print(f"阶段2完成：共选出 {len(unique_selected_titles_stage2)} 个不重复的候选标题。")
+        # 阶段2: 多轮淘汰赛评分和选择标题
+        echo("\n阶段2：评分和筛选候选标题...")
+        unique_selected_titles_stage2 = await self._tournament_select(unique_initial_titles, question, cognitive, goal)
+
+        echo(f"阶段2完成：共选出 {len(unique_selected_titles_stage2)} 个不重复的候选标题。")
         append_text("decomposer_history.txt", f"--- 阶段2 不重复候选标题 ---\n{json.dumps(unique_selected_titles_stage2, ensure_ascii=False, indent=2)}\n--- End ---", output_dir=self.output_dir)
 
         # 阶段3: 最终选择并添加理由
-        print("\n阶段3：最终选择并添加理由...")
+        echo("\n阶段3：最终选择并添加理由...")
         final_decomposition_result = await self._finalize_selection_and_add_reasons(
             unique_selected_titles_stage2, question, cognitive, goal, custom_branch
         )
         
-        print("问题分解流程完成。")
+        echo("问题分解流程完成。")
         # 将最终结果写入 decomposer_history.txt 和 分解结构.json
         # 这个写入分解结构.json的逻辑可以移到 workflow.py 中，或者在这里也保留一份详细日志
         append_text("decomposer_final_structure.json.log", json.dumps(final_decomposition_result, ensure_ascii=False, indent=2), output_dir=self.output_dir)
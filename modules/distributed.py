@@ -0,0 +1,167 @@
+import asyncio
+import os
+import socket
+from modules.api_client import APIClient, ResearchAPIClient
+from modules.researcher import Researcher
+from modules.evaluator import Evaluator
+from utils.task_queue import TaskQueue, RateLimiter
+from utils.events import echo, emit, BranchStarted, BranchCompleted
+from utils.metrics import metrics
+from utils.session_catalog import start_session_usage, add_session_usage
+
+# 每个任务按会话目录新建轻量的 Researcher/Evaluator，但共用 worker 创建的一组 API 客户端，
+# 不为每个会话各建一套连接池，长期运行的 worker 不会随处理过的会话数增长
+
+async def _handle_research(payload: dict, clients: tuple) -> str:
+    researcher = Researcher(payload["output_dir"], clients=clients)
+    return await researcher.process_question(
+        question=payload["question"],
+        index=payload["index"],
+        main_topic=payload["main_topic"],
+        all_branches=payload["all_branches"],
+        use_research_client=payload["use_research_client"]
+    )
+
+async def _handle_evaluate(payload: dict, clients: tuple) -> dict:
+    evaluator = Evaluator(payload["output_dir"], clients=clients)
+    return await evaluator.evaluate_and_optimize(payload["content"], payload.get("title", ""))
+
+# 任务类型 -> 执行函数，编排端与 worker 共用
+TASK_HANDLERS = {
+    "research": _handle_research,
+    "evaluate": _handle_evaluate,
+}
+
+async def _run_task(task: dict, clients: tuple) -> dict:
+    """在独立的用量累加器中执行任务，结果连同本任务的用量一起写回队列，供编排端计入会话统计"""
+    usage = start_session_usage()
+    content = await TASK_HANDLERS[task["kind"]](task["payload"], clients)
+    return {"content": content, "usage": usage}
+
+
+class DistributedExecutor:
+    """编排端：把分支研究与评估放入共享任务队列，由一个或多个 worker.py 进程执行
+
+    编排端自己的调用（问题分解、归纳、优化改写等）使用 create_clients 创建的客户端，
+    与 worker 共享同一个速率限制，max_per_minute/max_concurrent 应与 worker 的设置一致。
+    """
+
+    def __init__(self, queue_path: str, poll_interval: float = 1.0, max_attempts: int = 3,
+                 max_per_minute: int = 60, max_concurrent: int = 6):
+        self.queue = TaskQueue(queue_path)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.rate_limiter = RateLimiter(queue_path, max_per_minute=max_per_minute, max_concurrent=max_concurrent)
+
+    def create_clients(self) -> tuple:
+        """创建受共享速率限制约束的 (主账号, 研究账号) 客户端，供编排端各模块使用"""
+        return APIClient(rate_limiter=self.rate_limiter), ResearchAPIClient(rate_limiter=self.rate_limiter)
+
+    async def _submit(self, kind: str, payloads: list) -> list:
+        return [
+            await asyncio.to_thread(self.queue.enqueue, kind, payload, self.max_attempts)
+            for payload in payloads
+        ]
+
+    async def _wait(self, task_ids: list, on_done=None) -> list:
+        """等待任务完成，把 worker 上报的用量计入当前会话，返回各任务的结果内容"""
+        results = await self.queue.wait_for(task_ids, self.poll_interval, on_done=on_done)
+        for result in results:
+            add_session_usage(result["usage"])
+        return [result["content"] for result in results]
+
+    async def parallel_research(self, questions: list, main_topic: str, output_dir: str) -> list:
+        """与 Researcher.parallel_research 等价，但由 worker 进程执行；分支开始与完成时发出事件"""
+        # worker 的工作目录可能不同，统一传绝对路径
+        output_dir = os.path.abspath(output_dir)
+        metrics.inc("aipro_branches_scheduled_total", len(questions))
+        task_ids = await self._submit("research", [
+            {
+                "output_dir": output_dir,
+                "question": question,
+                "index": i,
+                "main_topic": main_topic,
+                "all_branches": questions,
+                "use_research_client": i % 2 == 1,  # 交替使用两个账号
+            }
+            for i, question in enumerate(questions)
+        ])
+        echo(f"已提交 {len(task_ids)} 个研究任务到队列 {self.queue.path}，等待 worker 执行...")
+        for i, question in enumerate(questions):
+            emit(BranchStarted(index=i, title=question["标题"]))
+
+        def on_done(task_id: int, result: dict):
+            i = task_ids.index(task_id)
+            echo(f"完成第 {i + 1} 个方面的探讨（由 worker 执行）")
+            metrics.inc("aipro_branches_completed_total")
+            emit(BranchCompleted(index=i, title=questions[i]["标题"], content=result["content"]))
+
+        return await self._wait(task_ids, on_done=on_done)
+
+    async def evaluate(self, content: str, output_dir: str, title: str = "") -> dict:
+        """与 Evaluator.evaluate_and_optimize 等价，但由 worker 进程执行"""
+        task_ids = await self._submit("evaluate", [{"output_dir": os.path.abspath(output_dir), "content": content, "title": title}])
+        return (await self._wait(task_ids))[0]
+
+
+async def _keep_alive(queue: TaskQueue, task: dict, owner: str, lease_seconds: float, work: asyncio.Task) -> bool:
+    """定期续约；租约被他人接管时取消当前执行并返回 True，避免同一任务重复执行"""
+    while not work.done():
+        await asyncio.sleep(lease_seconds / 3)
+        if not await asyncio.to_thread(queue.heartbeat, task["id"], owner, lease_seconds):
+            echo(f"[worker] 任务 {task['id']} 的租约已失效，放弃执行")
+            work.cancel()
+            return True
+    return False
+
+async def run_worker(queue_path: str, concurrency: int = 3, lease_seconds: float = 60,
+                     max_per_minute: int = 60, max_concurrent: int = 6,
+                     poll_interval: float = 1.0, idle_exit: float = None, worker_id: str = None) -> None:
+    """
+    无状态 worker：不断从队列领取任务、调用API并写回结果。
+
+    Args:
+        queue_path: 共享的任务队列文件
+        concurrency: 本进程同时执行的任务数
+        lease_seconds: 任务租约时长，执行期间每 1/3 租约时长续约一次
+        max_per_minute / max_concurrent: 所有 worker 共享的每分钟请求数与并发调用上限
+        idle_exit: 连续空闲超过该秒数后退出，None 表示一直运行
+    """
+    queue = TaskQueue(queue_path)
+    rate_limiter = RateLimiter(queue_path, max_per_minute=max_per_minute, max_concurrent=max_concurrent)
+    clients = (APIClient(rate_limiter=rate_limiter), ResearchAPIClient(rate_limiter=rate_limiter))
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    echo(f"[worker] {worker_id} 启动，队列：{queue_path}，并发：{concurrency}")
+
+    async def loop(slot: int):
+        owner = f"{worker_id}-{slot}"
+        idle_since = asyncio.get_running_loop().time()
+        while True:
+            task = await asyncio.to_thread(queue.claim, owner, lease_seconds, list(TASK_HANDLERS))
+            if task is None:
+                if idle_exit is not None and asyncio.get_running_loop().time() - idle_since > idle_exit:
+                    return
+                await asyncio.sleep(poll_interval)
+                continue
+
+            echo(f"[worker] {owner} 领取任务 {task['id']}（{task['kind']}，第 {task['attempts']} 次尝试）")
+            work = asyncio.create_task(_run_task(task, clients))
+            keep_alive = asyncio.create_task(_keep_alive(queue, task, owner, lease_seconds, work))
+            try:
+                result = await work
+            except asyncio.CancelledError:
+                lease_lost = keep_alive.done() and not keep_alive.cancelled() and keep_alive.result()
+                if not lease_lost:
+                    raise
+                # 租约被接管导致的取消：任务已由其他 worker 负责，这里直接继续领取下一个
+            except Exception as e:
+                echo(f"[worker] 任务 {task['id']} 失败：{e}")
+                await asyncio.to_thread(queue.fail, task["id"], owner, repr(e))
+            else:
+                await asyncio.to_thread(queue.complete, task["id"], owner, result)
+            finally:
+                keep_alive.cancel()
+            idle_since = asyncio.get_running_loop().time()
+
+    await asyncio.gather(*[loop(i) for i in range(concurrency)])
+    echo(f"[worker] {worker_id} 空闲超时，退出")
@@ -1,14 +1,52 @@
+import asyncio
+import hashlib
 import json
 import re
 from config import WORKFLOW_STAGES
-from modules.api_client import APIClient
+from modules.api_client import APIClient, ResearchAPIClient
 from utils.file_utils import append_text, write_text
 from utils.resource_tracker import update_resource_usage
+from utils.text_utils import extract_json, parse_score
+from utils.events import echo
+
+# 章节标题：报告中二级及更深的 markdown 标题，每个标题到下一个标题之间为一个章节
+SECTION_HEADING_PATTERN = re.compile(r"^#{2,6}\s+.+$", re.MULTILINE)
+
+def split_sections(report: str) -> list:
+    """将报告按标题拆分为章节，拼接 join_sections(split_sections(report)) 可无损还原"""
+    sections = []
+    matches = list(SECTION_HEADING_PATTERN.finditer(report))
+    if not matches or matches[0].start() > 0:
+        # 第一个标题之前的内容作为无标题章节保留，不参与改写
+        end = matches[0].start() if matches else len(report)
+        sections.append({"标题行": "", "标题": "", "内容": report[:end]})
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(report)
+        heading = match.group(0)
+        sections.append({
+            "标题行": heading,
+            "标题": heading.lstrip("#").strip(),
+            "内容": report[match.end():end],
+        })
+    return sections
+
+def join_sections(sections: list) -> str:
+    return "".join(section["标题行"] + section["内容"] for section in sections)
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+
+def _bigrams(text: str) -> set:
+    text = re.sub(r"\s+", "", text)
+    return {text[i:i + 2] for i in range(len(text) - 1)}
 
 class Evaluator:
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, clients: tuple = None):
+        """clients: 可选的 (主账号, 研究账号) 客户端，多个实例共用同一组连接时传入"""
         self.output_dir = output_dir
-        self.api_client = APIClient()
+        self.api_client, self.research_api_client = clients or (APIClient(), ResearchAPIClient())
+        # 章节改写与评估轮流分配给两个账号
+        self.clients = [self.api_client, self.research_api_client]
 
     def clean_ai_response(self, text: str) -> str:
         """清理AI返回的文本，移除think标签及其内容"""
@@ -49,7 +87,7 @@ class Evaluator:
 文章内容如下：
 {content[:3000]}
 """
-        print(f"\n开始评估文章: {title if title else '最终报告'}")
+        echo(f"\n开始评估文章: {title if title else '最终报告'}")
         
         result = await self.api_client.call_model(
             model=WORKFLOW_STAGES['scoring'],
@@ -67,13 +105,13 @@ class Evaluator:
         # 提取JSON
         match = re.search(r'(\{.*\})', result, re.DOTALL)
         if not match:
-            print("无法提取JSON，返回文本：", result)
+            echo("无法提取JSON，返回文本：", result)
             raise ValueError("无法提取JSON结构")
         
         json_str = match.group(1).strip()
         try:
             evaluation = json.loads(json_str)
-            print(f"评分完成: {evaluation['评分']}分")
+            echo(f"评分完成: {evaluation['评分']}分")
             
             # 确保评估结果中的文本也经过清理
             if "评分理由" in evaluation:
@@ -85,5 +123,169 @@ class Evaluator:
             
             return evaluation
         except json.JSONDecodeError as e:
-            print(f"JSON解析错误，提取后的JSON文本：{json_str}")
-            raise e
\ No newline at end of file
+            echo(f"JSON解析错误，提取后的JSON文本：{json_str}")
+            raise e
+
+    def map_suggestions_to_sections(self, suggestions: list, sections: list) -> dict:
+        """
+        将优化建议映射到最相关的章节：建议中直接提到章节标题时优先匹配，
+        否则按与章节标题和开头内容的二元字组重合度选择最高者；完全无重合的建议被忽略。
+        返回 {章节序号: [建议, ...]}。
+        """
+        mapping = {}
+        candidates = [(i, s) for i, s in enumerate(sections) if s["标题"]]
+        for suggestion in suggestions:
+            best_index, best_score = None, 0.0
+            suggestion_bigrams = _bigrams(suggestion)
+            for i, section in candidates:
+                score = len(suggestion_bigrams & _bigrams(section["标题"])) * 3
+                score += len(suggestion_bigrams & _bigrams(section["内容"][:500]))
+                if section["标题"] in suggestion:
+                    score += 100
+                if score > best_score:
+                    best_index, best_score = i, score
+            if best_index is not None:
+                mapping.setdefault(best_index, []).append(suggestion)
+        return mapping
+
+    async def _rewrite_section(self, section: dict, suggestions: list, client: APIClient) -> str:
+        """按建议改写单个章节，只返回改写后的正文"""
+        suggestions_str = "\n".join(f"- {s}" for s in suggestions)
+        prompt = f"""下面是一篇报告中"{section['标题']}"这一章节的正文，以及评审对它提出的修改意见。
+请根据修改意见改写这一章节：保留原有的风格和结构，修正指出的事实错误，补充欠缺的内容，不要涉及其他章节的话题。
+只输出改写后的正文，不要输出章节标题或任何解释。
+
+修改意见：
+{suggestions_str}
+
+章节正文：
+{section['内容'].strip()}
+"""
+        result = await client.call_model(
+            model=WORKFLOW_STAGES['research'],
+            messages=[{"role": "user", "content": prompt}],
+            temp=0.6
+        )
+        update_resource_usage(call_count=1, word_count=len(result))
+        append_text("evaluator_history.txt", f"--- 改写章节: {section['标题']} ---\n{result}\n--- End ---", output_dir=self.output_dir)
+        return self.clean_ai_response(result)
+
+    async def _evaluate_section(self, section: dict, client: APIClient) -> dict:
+        """评估单个章节，返回 {"评分", "优化建议", "事实更正"}；解析失败时评分为 None"""
+        prompt = f"""请评估下面这一报告章节"{section['标题']}"的质量，并严格按照下面格式返回JSON：
+{{
+    "评分": 0,
+    "优化建议": ["建议1", ...],
+    "事实更正": ["更正1", ...]
+}}
+
+章节正文：
+{section['内容'].strip()[:3000]}
+"""
+        result = await client.call_model(
+            model=WORKFLOW_STAGES['scoring'],
+            messages=[{"role": "user", "content": prompt}],
+            temp=0.4
+        )
+        update_resource_usage(call_count=1, word_count=len(result))
+        result = self.clean_ai_response(result)
+        append_text("evaluator_history.txt", f"--- 评估章节: {section['标题']} ---\n{result}\n--- End ---", output_dir=self.output_dir)
+        try:
+            evaluation = json.loads(extract_json(result))
+            return {
+                "评分": parse_score(evaluation.get("评分")),
+                "优化建议": [self.clean_ai_response(s) for s in evaluation.get("优化建议", [])],
+                "事实更正": [self.clean_ai_response(c) for c in evaluation.get("事实更正", [])],
+            }
+        except (json.JSONDecodeError, TypeError, ValueError):
+            echo(f"警告：章节「{section['标题']}」的评估结果无法解析")
+            return {"评分": None, "优化建议": [], "事实更正": []}
+
+    async def optimize_report(self, report: str, evaluation: dict, target_score: float = 8,
+                              max_iterations: int = 2, max_calls: int = 30) -> dict:
+        """
+        根据评估结果迭代优化报告：
+        1. 把 优化建议/事实更正 映射到相关章节；
+        2. 只并行改写有建议的章节；
+        3. 只对内容哈希发生变化的章节重新评估（结果按哈希缓存），得到下一轮的章节级建议；
+        4. 达到 target_score、max_iterations 或 max_calls 时停止。
+        
+        未重新评估过的章节沿用整篇报告的原始评分，用于估算优化后评分。
+        返回值中的 已采纳建议 为已用于改写的建议，剩余建议 为因预算、改写失败或无法对应到章节而未处理的建议。
+        """
+        sections = split_sections(report)
+        base_score = parse_score(evaluation.get("评分")) or 0.0
+        section_scores = {}  # 章节序号 -> 最新评分
+        evaluation_cache = {}  # 内容哈希 -> 章节评估结果
+        calls = 0
+        rewritten = set()
+        all_suggestions = list(evaluation.get("事实更正", [])) + list(evaluation.get("优化建议", []))
+        pending = self.map_suggestions_to_sections(all_suggestions, sections)
+        applied = []
+        mapped = {s for items in pending.values() for s in items}
+        remaining = [s for s in all_suggestions if s not in mapped]
+
+        def estimated_score() -> float:
+            scores = [section_scores.get(i, base_score) for i, s in enumerate(sections) if s["标题"]]
+            return sum(scores) / len(scores) if scores else base_score
+
+        iteration = 0
+        while iteration < max_iterations and pending and estimated_score() < target_score:
+            # 每个改写的章节之后还需要一次评估，按两次调用预留预算
+            targets = sorted(pending)[:(max_calls - calls) // 2]
+            if not targets:
+                break
+            iteration += 1
+            echo(f"优化第 {iteration} 轮：并行改写 {len(targets)} 个章节...")
+            results = await asyncio.gather(*[
+                self._rewrite_section(sections[i], pending[i], self.clients[n % len(self.clients)])
+                for n, i in enumerate(targets)
+            ], return_exceptions=True)
+            calls += len(targets)
+
+            changed = []
+            for i, result in zip(targets, results):
+                if isinstance(result, Exception) or not result.strip():
+                    continue
+                old_hash = content_hash(sections[i]["内容"])
+                sections[i]["内容"] = f"\n\n{result.strip()}\n\n"
+                if content_hash(sections[i]["内容"]) != old_hash:
+                    changed.append(i)
+                    rewritten.add(i)
+            for i in sorted(pending):
+                if i in changed:
+                    applied += pending[i]
+                else:
+                    # 超出预算或改写失败的章节本次不再重试，其建议作为剩余建议返回
+                    remaining += pending[i]
+
+            to_evaluate = [i for i in changed if content_hash(sections[i]["内容"]) not in evaluation_cache]
+            results = await asyncio.gather(*[
+                self._evaluate_section(sections[i], self.clients[n % len(self.clients)])
+                for n, i in enumerate(to_evaluate)
+            ], return_exceptions=True)
+            calls += len(to_evaluate)
+            for i, result in zip(to_evaluate, results):
+                if not isinstance(result, Exception):
+                    evaluation_cache[content_hash(sections[i]["内容"])] = result
+
+            pending = {}
+            for i in changed:
+                section_evaluation = evaluation_cache.get(content_hash(sections[i]["内容"]))
+                if not section_evaluation or section_evaluation["评分"] is None:
+                    continue
+                section_scores[i] = section_evaluation["评分"]
+                suggestions = section_evaluation["事实更正"] + section_evaluation["优化建议"]
+                if section_evaluation["评分"] < target_score and suggestions:
+                    pending[i] = suggestions
+            echo(f"优化第 {iteration} 轮完成：估算评分 {estimated_score():.1f}，累计调用 {calls} 次")
+
+        return {
+            "报告内容": join_sections(sections),
+            "优化后评分": round(estimated_score(), 1),
+            "迭代次数": iteration,
+            "调用次数": calls,
+            "改写章节": [sections[i]["标题"] for i in sorted(rewritten)],
+            "已采纳建议": applied,
+            "剩余建议": remaining + [s for i in sorted(pending) for s in pending[i]],
+        }
@@ -1,17 +1,24 @@
 import asyncio
+import itertools
+import json
+import re
 from config import WORKFLOW_STAGES
 from modules.api_client import APIClient, ResearchAPIClient
 from utils.file_utils import append_text
 from utils.resource_tracker import update_resource_usage
+from utils.metrics import metrics
+from utils.events import echo, emit, BranchStarted, BranchCompleted
 
 class Researcher:
-    def __init__(self, output_dir: str, max_concurrency: int = 6):
+    def __init__(self, output_dir: str, max_concurrency: int = 6, clients: tuple = None):
+        """clients: 可选的 (主账号, 研究账号) 客户端，多个实例共用同一组连接时传入"""
         self.output_dir = output_dir
-        self.api_client = APIClient()  # 主账号
-        self.research_api_client = ResearchAPIClient()  # 研究专用账号
+        # 主账号与研究专用账号
+        self.api_client, self.research_api_client = clients or (APIClient(), ResearchAPIClient())
         self.max_concurrency = max_concurrency  # 增加到 6，因为现在有两个账号
 
-    async def process_question(self, question: dict, index: int, main_topic: str, all_branches: list, use_research_client: bool = False):
+    async def process_question(self, question: dict, index: int, main_topic: str, all_branches: list, use_research_client: bool = False,
+                               parent_path: list = None, usage: dict = None):
         """深入探讨某个具体问题
         
         Args:
@@ -20,17 +27,23 @@ class Researcher:
             main_topic: 主要话题
             all_branches: 所有分支的列表
             use_research_client: 是否使用备用账号
+            parent_path: 递归研究时，从顶层分支到当前节点父级的标题路径
+            usage: 可选字典，用于累加本次调用的 token 用量
         """
         client = self.research_api_client if use_research_client else self.api_client
-        print(f"开始探讨第 {index + 1} 个方面: {question['标题']}")
+        echo(f"开始探讨第 {index + 1} 个方面: {question['标题']}")
+        emit(BranchStarted(index=index, title=question['标题'], path=list(parent_path or [])))
         
+        # 递归研究时告诉模型当前节点在研究树中的位置
+        path_hint = f"我们已经从\"{' → '.join(parent_path)}\"一路深入到这里。\n" if parent_path else ""
+
         # 构建更友好的对话提示
         prompt = f"""让我们一起来聊聊"{main_topic}"这个有趣的话题！
 
 这个问题有不同的角度：
 {', '.join([b['标题'] for b in all_branches])}
 
-现在，我想请你重点集中谈"{question['标题']}"这个方面。
+{path_hint}现在，我想请你重点集中谈"{question['标题']}"这个方面。
 
 在分享你的想法时，请：
 1. 请形象生动的告诉我
@@ -43,12 +56,15 @@ class Researcher:
         answer = await client.call_model(
             model=WORKFLOW_STAGES['research'],
             messages=[{"role": "user", "content": prompt}],
-            temp=0.8  # 稍微提高温度，让回答更自然
+            temp=0.8,  # 稍微提高温度，让回答更自然
+            usage=usage
         )
         update_resource_usage(call_count=1, word_count=len(answer))
         log_entry = f"Topic {index + 1}: {question['标题']}\nThoughts: {answer}\n{'-' * 40}"
         append_text("researcher_history.txt", log_entry, output_dir=self.output_dir)
-        print(f"完成第 {index + 1} 个方面的探讨")
+        metrics.inc("aipro_branches_completed_total")
+        emit(BranchCompleted(index=index, title=question['标题'], content=answer, path=list(parent_path or [])))
+        echo(f"完成第 {index + 1} 个方面的探讨")
         return answer
 
     async def parallel_research(self, questions: list, main_topic: str) -> list:
@@ -58,6 +74,7 @@ class Researcher:
             questions: 问题列表
             main_topic: 主要研究主题
         """
+        metrics.inc("aipro_branches_scheduled_total", len(questions))
         tasks = []
         for i, question in enumerate(questions):
             # 交替使用两个账号以提高并行效率
@@ -71,4 +88,138 @@ class Researcher:
             )
             tasks.append(task)
         
-        return await asyncio.gather(*tasks)
\ No newline at end of file
+        return await asyncio.gather(*tasks)
+
+    async def _expand_branch(self, node: dict, main_topic: str, max_children: int, use_research_client: bool, usage: dict) -> list:
+        """根据已完成的节点内容，让AI提出更深入的子分支标题"""
+        client = self.research_api_client if use_research_client else self.api_client
+        path = " → ".join(node["路径"] + [node["标题"]])
+        # 回答以 <think> 推理过程开头，先去掉再截取，让提示里保留的是正文
+        content = re.sub(r'<think>.*?</think>', '', node["内容"], flags=re.DOTALL)
+        content = re.sub(r'<think>\s*\n\s*嗯', '', content).strip()
+        prompt = f"""我们正在研究"{main_topic}"，目前已经深入到"{path}"这个方面，已有的探讨如下：
+
+{content[:2000]}
+
+请在此基础上提出最多{max_children}个值得进一步深入、彼此不重复、且与上面内容不重复的子方向标题。
+请严格以JSON字符串列表的格式返回，例如：
+["子方向1", "子方向2"]
+不要包含任何其他解释性文字或标记。
+"""
+        result = await client.call_model(
+            model=WORKFLOW_STAGES['decomposition'],
+            messages=[{"role": "user", "content": prompt}],
+            temp=0.6,
+            usage=usage
+        )
+        update_resource_usage(call_count=1, word_count=len(result))
+        result = re.sub(r'<think>.*?</think>', '', result, flags=re.DOTALL)
+        match = re.search(r'\[.*?\]', result, re.DOTALL)
+        if not match:
+            return []
+        try:
+            titles = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return []
+        existing = set(node["路径"]) | {node["标题"]}
+        children = []
+        for title in titles:
+            if isinstance(title, str) and title.strip() and title not in existing:
+                existing.add(title)
+                children.append(title.strip())
+        return children[:max_children]
+
+    async def recursive_research(self, questions: list, main_topic: str, max_depth: int = 2, max_children: int = 3,
+                                 max_calls: int = 200, max_tokens: int = None) -> list:
+        """递归研究：每个分支完成后可继续分解为子分支，直到 max_depth 层
+        
+        所有节点由一个全局优先队列调度：按层级优先（广度优先，保证各分支公平推进），
+        由 max_concurrency 个工作协程并发消费。调用预算在入队时预留，已入队的节点一定能被研究；
+        token 预算为软上限，超出后不再发起新调用。
+        
+        Args:
+            questions: 顶层分支列表（分解结果中的子问题）
+            main_topic: 主要研究主题
+            max_depth: 最大层级，0 表示只研究顶层分支
+            max_children: 每个节点最多展开的子分支数
+            max_calls: 整个研究树的API调用总预算（研究与展开都计入）
+            max_tokens: 整个研究树的 token 总预算，None 表示不限制
+        
+        Returns:
+            研究树：[{"标题", "理由", "层级", "路径", "内容", "子分支": [...]}, ...]
+        """
+        queue = asyncio.PriorityQueue()
+        sequence = itertools.count()
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        budget = {"committed": 0, "nodes": 0}  # committed: 已发起的调用数 + 队列中节点预留的调用数
+
+        def tokens_exhausted() -> bool:
+            return max_tokens is not None and usage["prompt_tokens"] + usage["completion_tokens"] >= max_tokens
+
+        def enqueue(node: dict):
+            budget["committed"] += 1
+            budget["nodes"] += 1
+            metrics.inc("aipro_branches_scheduled_total")
+            queue.put_nowait((node["层级"], next(sequence), node))
+
+        roots = []
+        for question in questions[:max_calls]:
+            node = {"标题": question["标题"], "理由": question.get("理由", ""), "层级": 0,
+                    "路径": [], "兄弟分支": questions, "内容": None, "子分支": []}
+            roots.append(node)
+            enqueue(node)
+
+        async def worker():
+            while True:
+                _, index, node = await queue.get()
+                try:
+                    if tokens_exhausted():
+                        continue
+                    node["内容"] = await self.process_question(
+                        question=node, index=index, main_topic=main_topic, all_branches=node["兄弟分支"],
+                        use_research_client=index % 2 == 1, parent_path=node["路径"], usage=usage
+                    )
+                    # 展开需要1次调用，并在等待AI返回前先为子分支预留调用，避免并发展开超出预算
+                    slots = min(max_children, max_calls - budget["committed"] - 1)
+                    if node["层级"] >= max_depth or slots < 1 or tokens_exhausted():
+                        continue
+                    budget["committed"] += 1 + slots
+                    try:
+                        titles = await self._expand_branch(node, main_topic, slots, index % 2 == 0, usage)
+                    finally:
+                        budget["committed"] -= slots  # 释放预留，实际入队的子分支在 enqueue 中重新计入
+                    siblings = [{"标题": title} for title in titles]
+                    for title in titles:
+                        child = {"标题": title, "理由": "", "层级": node["层级"] + 1,
+                                 "路径": node["路径"] + [node["标题"]], "兄弟分支": siblings,
+                                 "内容": None, "子分支": []}
+                        node["子分支"].append(child)
+                        enqueue(child)
+                except Exception as e:
+                    echo(f"警告：节点「{node['标题']}」研究失败：{e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        def prune(nodes: list) -> list:
+            """去掉因预算耗尽或失败而没有内容的节点，以及调度用的临时字段"""
+            result = []
+            for node in nodes:
+                if node["内容"] is None:
+                    continue
+                node.pop("兄弟分支", None)
+                node["子分支"] = prune(node["子分支"])
+                result.append(node)
+            return result
+
+        tree = prune(roots)
+        echo(f"递归研究完成：共 {budget['nodes']} 个节点入队，已用调用预算 {budget['committed']}/{max_calls}，"
+              f"tokens {usage['prompt_tokens'] + usage['completion_tokens']}")
+        return tree
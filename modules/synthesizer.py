@@ -1,11 +1,30 @@
+import asyncio
 import json
+import re
+from config import WORKFLOW_STAGES
+from modules.api_client import APIClient, ResearchAPIClient
 from utils.file_utils import append_text
+from utils.resource_tracker import update_resource_usage
+from utils.text_utils import extract_json
+from utils.events import echo
 
 class Synthesizer:
-    def __init__(self, output_dir: str):
+    def __init__(self, output_dir: str, group_size: int = 3, max_item_chars: int = 2500):
+        """
+        Args:
+            output_dir: 输出目录
+            group_size: 归纳分析时每次合并的条目数，树的深度约为 log(分支数)/log(group_size)
+            max_item_chars: 每个条目送入提示的最大字数，保证单次调用的提示长度有上限
+        """
+        if group_size < 2:
+            raise ValueError(f"group_size 至少为2，当前为 {group_size}")
         self.output_dir = output_dir
-        # 不再需要API客户端，直接进行文本拼接即可
-        pass
+        self.group_size = group_size
+        self.max_item_chars = max_item_chars
+        # 拼接报告不需要API；只有归纳分析（摘要、矛盾、阅读顺序）才调用模型，两个账号轮流使用
+        self.api_client = APIClient()
+        self.research_api_client = ResearchAPIClient()
+        self.clients = [self.api_client, self.research_api_client]
 
     async def synthesize_report(self, components: dict) -> str:
         """
@@ -35,4 +54,139 @@ class Synthesizer:
         
         # 写入日志
         append_text("synthesizer_history.txt", final_report, output_dir=self.output_dir)
-        return final_report
\ No newline at end of file
+        return final_report
+
+    def _render_tree(self, nodes: list, level: int, numbering: str, lines: list) -> None:
+        for i, node in enumerate(nodes, start=1):
+            number = f"{numbering}{i}."
+            lines.append(f"{'#' * min(level, 6)} {number} {node['标题']}")
+            lines.append("")
+            lines.append(node["内容"])
+            lines.append("")
+            self._render_tree(node.get("子分支", []), level + 1, number, lines)
+
+    async def synthesize_tree_report(self, tree: list, heading_level: int = 1) -> str:
+        """
+        将递归研究树生成嵌套报告：每深入一层标题级别加一，并带有 1.2.3 形式的编号。
+        
+        树节点格式：
+            {"标题": "...", "内容": "...", "子分支": [同样格式的节点, ...]}
+        """
+        final_lines = []
+        self._render_tree(tree, heading_level, "", final_lines)
+        final_report = "\n".join(final_lines)
+
+        # 写入日志
+        append_text("synthesizer_history.txt", final_report, output_dir=self.output_dir)
+        return final_report
+
+
+    @staticmethod
+    def _as_list(value) -> list:
+        """模型有时把列表字段写成单个字符串，统一包成列表，避免按字符逐个迭代"""
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def _format_item(self, item: dict) -> str:
+        """把一个待合并的条目（原始分支或下层的归纳结果）整理成提示中的一段文字"""
+        if "内容" in item:
+            return f"【分支】{item['标题']}\n{item['内容'][:self.max_item_chars]}"
+        contradictions = "\n".join(f"- {c}" for c in item["矛盾"]) or "- 无"
+        return (f"【已归纳的分支组】{'、'.join(item['阅读顺序'])}\n摘要：{item['摘要'][:self.max_item_chars]}\n"
+                f"组内矛盾：\n{contradictions}")
+
+    async def _reduce_group(self, items: list, main_topic: str, client: APIClient) -> dict:
+        """将一组条目合并为一个归纳结果：摘要、分支间矛盾、阅读顺序"""
+        titles = [title for item in items for title in item["阅读顺序"]]
+        items_str = "\n\n".join(self._format_item(item) for item in items)
+        prompt = f"""下面是关于"{main_topic}"的研究报告中的若干部分，每部分可能是单个分支的原文，也可能是已经归纳过的一组分支。
+请把它们归纳为一个整体：
+1. 写一段不超过400字的摘要，覆盖所有部分的要点
+2. 找出不同部分之间相互矛盾或说法不一致的地方（包括已归纳分支组中列出的矛盾），没有则返回空列表
+3. 给出这些分支的推荐阅读顺序（从基础到深入），只能使用下面列出的分支标题
+
+涉及的分支标题：{json.dumps(titles, ensure_ascii=False)}
+
+{items_str}
+
+请严格按照下面格式返回JSON，不要附加任何其他文字：
+{{
+    "摘要": "...",
+    "矛盾": ["矛盾1", ...],
+    "阅读顺序": ["分支标题", ...]
+}}
+"""
+        result = await client.call_model(
+            model=WORKFLOW_STAGES['verification'],
+            messages=[{"role": "user", "content": prompt}],
+            temp=0.4
+        )
+        update_resource_usage(call_count=1, word_count=len(result))
+        result = re.sub(r'<think>.*?</think>', '', result, flags=re.DOTALL).strip()
+        append_text("synthesizer_history.txt", f"--- 归纳 {len(items)} 个条目 ---\n{result}\n--- End ---", output_dir=self.output_dir)
+
+        merged_contradictions = [c for item in items for c in self._as_list(item.get("矛盾"))]
+        try:
+            reduced = json.loads(extract_json(result))
+            summary = str(reduced.get("摘要", "")).strip()
+            contradictions = [str(c) for c in self._as_list(reduced.get("矛盾")) if str(c).strip()]
+            order = [t for t in self._as_list(reduced.get("阅读顺序")) if t in titles]
+        except (json.JSONDecodeError, AttributeError):
+            echo("警告：归纳结果无法解析，回退为直接合并下层结果")
+            summary, contradictions, order = "", merged_contradictions, []
+        if not summary:
+            summary = "\n".join(item.get("摘要", item.get("内容", ""))[:300] for item in items)
+        # 保证阅读顺序覆盖组内全部分支且不重复
+        order = list(dict.fromkeys(order + titles))
+        return {"摘要": summary, "矛盾": contradictions, "阅读顺序": order}
+
+    @staticmethod
+    async def _pass_through(item: dict) -> dict:
+        """落单的已归纳条目直接进入下一层，不再额外调用模型"""
+        return item
+
+    async def synthesize_with_analysis(self, titles: list, contents: list, main_topic: str = "") -> dict:
+        """
+        树形归纳：每层把条目按 group_size 分组并行合并，直到只剩一个结果。
+        总延迟随 log(分支数) 增长，且每次调用的提示长度有上限，不受报告总长度影响。
+        
+        Returns:
+            {"摘要": "...", "矛盾": [...], "阅读顺序": [分支标题, ...]}
+        """
+        if len(titles) != len(contents):
+            raise ValueError(f"子问题标题与研究结果数量不匹配！标题数：{len(titles)}，内容数：{len(contents)}")
+        if not titles:
+            return {"摘要": "", "矛盾": [], "阅读顺序": []}
+
+        items = [{"标题": t, "内容": c, "阅读顺序": [t]} for t, c in zip(titles, contents)]
+        level = 0
+        # 单个分支也至少归纳一次，以生成摘要
+        while len(items) > 1 or "内容" in items[0]:
+            level += 1
+            groups = [items[i:i + self.group_size] for i in range(0, len(items), self.group_size)]
+            echo(f"归纳第 {level} 层：{len(items)} 个条目分为 {len(groups)} 组并行合并...")
+            items = await asyncio.gather(*[
+                self._pass_through(group[0]) if len(group) == 1 and "内容" not in group[0]
+                else self._reduce_group(group, main_topic, self.clients[i % len(self.clients)])
+                for i, group in enumerate(groups)
+            ])
+        return items[0]
+
+    def render_analysis(self, analysis: dict) -> str:
+        """将归纳结果渲染为放在报告开头的 markdown"""
+        contradictions = "\n".join(f"- {c}" for c in analysis["矛盾"]) or "未发现明显矛盾。"
+        order = "\n".join(f"{i}. {t}" for i, t in enumerate(analysis["阅读顺序"], start=1))
+        return f"""## 执行摘要
+
+{analysis["摘要"]}
+
+## 分支间矛盾
+
+{contradictions}
+
+## 推荐阅读顺序
+
+{order}
+
+"""
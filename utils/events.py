@@ -0,0 +1,92 @@
+import contextvars
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+# 当前上下文中的事件接收函数与静默开关。asyncio 创建任务时会复制上下文，
+# 因此在工作流任务中设置一次，其内部 gather/create_task 产生的所有子任务都会继承
+_event_sink: contextvars.ContextVar[Optional[Callable[["WorkflowEvent"], None]]] = contextvars.ContextVar("event_sink", default=None)
+_quiet: contextvars.ContextVar[bool] = contextvars.ContextVar("quiet", default=False)
+
+
+@dataclass(kw_only=True)
+class WorkflowEvent:
+    """所有工作流事件的基类"""
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class StageStarted(WorkflowEvent):
+    stage: str
+
+
+@dataclass
+class DecompositionReady(WorkflowEvent):
+    decomposition: dict
+
+
+@dataclass
+class BranchStarted(WorkflowEvent):
+    index: int
+    title: str
+    path: list = field(default_factory=list)  # 递归研究时，从顶层分支到父节点的标题路径
+
+
+@dataclass
+class BranchCompleted(WorkflowEvent):
+    index: int
+    title: str
+    content: str
+    path: list = field(default_factory=list)
+
+
+@dataclass
+class ReportAssembled(WorkflowEvent):
+    content: str
+
+
+@dataclass
+class EvaluationReady(WorkflowEvent):
+    evaluation: dict
+
+
+@dataclass
+class OptimizationReady(WorkflowEvent):
+    optimization: dict
+
+
+@dataclass
+class UsageUpdated(WorkflowEvent):
+    """每次API调用成功后发出，包含本次调用与进程内累计的用量"""
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency: float
+    total_calls: int
+
+
+@dataclass
+class WorkflowCompleted(WorkflowEvent):
+    result: dict
+
+
+def emit(event: WorkflowEvent) -> None:
+    """向当前上下文的事件接收者发送事件；没有接收者时什么也不做"""
+    sink = _event_sink.get()
+    if sink is not None:
+        sink(event)
+
+
+def set_event_sink(sink: Optional[Callable[[WorkflowEvent], None]]) -> None:
+    _event_sink.set(sink)
+
+
+def set_quiet(quiet: bool = True) -> None:
+    """让当前上下文（及之后创建的子任务）中经 echo 的输出静默，不影响其他任务"""
+    _quiet.set(quiet)
+
+
+def echo(*args, **kwargs) -> None:
+    """工作流内部使用的 print：当前上下文处于静默状态时不输出，参数与 print 相同"""
+    if not _quiet.get():
+        print(*args, **kwargs)
@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import sys
+import time
+
+# 指标说明与类型，用于 Prometheus 文本格式中的 HELP/TYPE 行
+METRIC_DEFINITIONS = {
+    "aipro_api_calls_total": ("counter", "API调用次数，按模型、账号与结果区分"),
+    "aipro_api_retries_total": ("counter", "API调用重试次数"),
+    "aipro_api_latency_seconds": ("histogram", "单次API调用耗时"),
+    "aipro_api_queue_wait_seconds": ("histogram", "等待全局并发信号量的时间"),
+    "aipro_api_queue_depth": ("gauge", "正在等待全局并发信号量的调用数"),
+    "aipro_api_in_flight": ("gauge", "正在进行中的API调用数，按账号区分"),
+    "aipro_tokens_total": ("counter", "累计 token 数，按模型与类型（prompt/completion）区分"),
+    "aipro_branches_scheduled_total": ("counter", "已安排研究的分支数"),
+    "aipro_branches_completed_total": ("counter", "已完成研究的分支数"),
+    "aipro_stage_active": ("gauge", "各阶段正在执行的工作流数"),
+    "aipro_stage_duration_seconds": ("histogram", "工作流各阶段耗时"),
+}
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+
+
+class Metrics:
+    """进程内的指标注册表：计数器、仪表与直方图，按 (名称, 标签) 存储"""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # key -> {"buckets": [...], "sum": float, "count": int}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels) -> None:
+        key = self._key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        histogram = self.histograms.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def total(self, name: str, **labels) -> float:
+        """汇总某个计数器或仪表在所有标签组合上的值（可按部分标签过滤）"""
+        result = 0
+        for store in (self.counters, self.gauges):
+            for (metric_name, metric_labels), value in store.items():
+                if metric_name == name and all(dict(metric_labels).get(k) == v for k, v in labels.items()):
+                    result += value
+        return result
+
+    def breakdown(self, name: str, label: str) -> dict:
+        """按某个标签汇总计数器或仪表，只返回非零的值，例如 {阶段: 正在执行的工作流数}"""
+        result = {}
+        for store in (self.counters, self.gauges):
+            for (metric_name, metric_labels), value in store.items():
+                if metric_name == name and value:
+                    key = dict(metric_labels).get(label)
+                    result[key] = result.get(key, 0) + value
+        return result
+
+    def histogram_mean(self, name: str) -> float:
+        total_sum = sum(h["sum"] for (n, _), h in self.histograms.items() if n == name)
+        total_count = sum(h["count"] for (n, _), h in self.histograms.items() if n == name)
+        return total_sum / total_count if total_count else 0.0
+
+    def stage_tracker(self) -> "StageTracker":
+        """为一个工作流创建阶段计时器"""
+        return StageTracker(self)
+
+    @contextlib.asynccontextmanager
+    async def track_semaphore(self, semaphore: asyncio.Semaphore, **labels):
+        """获取信号量，同时记录排队深度与等待时间"""
+        queued_at = time.monotonic()
+        self.add_gauge("aipro_api_queue_depth", 1)
+        try:
+            await semaphore.acquire()
+        finally:
+            self.add_gauge("aipro_api_queue_depth", -1)
+        self.observe("aipro_api_queue_wait_seconds", time.monotonic() - queued_at)
+        self.add_gauge("aipro_api_in_flight", 1, **labels)
+        try:
+            yield
+        finally:
+            self.add_gauge("aipro_api_in_flight", -1, **labels)
+            semaphore.release()
+
+    @staticmethod
+    def _format_labels(labels, extra: dict = None) -> str:
+        items = list(labels) + list((extra or {}).items())
+        if not items:
+            return ""
+        escaped = []
+        for key, value in items:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式输出所有指标"""
+        lines = []
+        names = sorted({name for name, _ in list(self.counters) + list(self.gauges) + list(self.histograms)})
+        for name in names:
+            metric_type, help_text = METRIC_DEFINITIONS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for store in (self.counters, self.gauges):
+                for (metric_name, labels), value in sorted(store.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+            for (metric_name, labels), histogram in sorted(self.histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, {'le': bound})} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, {'le': '+Inf'})} {histogram['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTracker:
+    """单个工作流的阶段计时：同一时间只处于一个阶段，切换时结束上一阶段并记录其耗时
+
+    每个工作流各自创建，对 aipro_stage_active 只做加一/减一，同一进程中并发运行的多个工作流互不覆盖。
+    """
+
+    def __init__(self, registry: Metrics):
+        self.registry = registry
+        self.stage = None
+        self._started = 0.0
+
+    def enter(self, stage: str = None) -> None:
+        """切换到新阶段；传入 None 表示结束当前阶段"""
+        if self.stage is not None:
+            self.registry.add_gauge("aipro_stage_active", -1, stage=self.stage)
+            self.registry.observe("aipro_stage_duration_seconds", time.monotonic() - self._started, stage=self.stage)
+        self.stage = stage
+        self._started = time.monotonic()
+        if stage is not None:
+            self.registry.add_gauge("aipro_stage_active", 1, stage=stage)
+
+
+# 全局指标实例，APIClient 与各工作流阶段都向它上报
+metrics = Metrics()
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        # 读完请求头，忽略内容
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split(b" ")[1] if len(request_line.split(b" ")) > 1 else b"/"
+        if path.split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf-8") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> asyncio.AbstractServer:
+    """启动本地 HTTP 服务，在 /metrics 以 Prometheus 文本格式暴露指标"""
+    server = await asyncio.start_server(_handle_request, host, port)
+    print(f"[监控] 指标地址：http://{host}:{port}/metrics")
+    return server
+
+
+def progress_line(previous: dict, interval: float) -> tuple:
+    """生成一行紧凑的进度信息，返回 (文本, 本次快照)，快照用于计算下一次的吞吐"""
+    snapshot = {
+        "tokens": metrics.total("aipro_tokens_total"),
+        "calls": metrics.total("aipro_api_calls_total"),
+    }
+    tokens_per_second = (snapshot["tokens"] - previous.get("tokens", 0)) / interval if previous else 0.0
+    # 各阶段正在执行的工作流数，例如 "research×2 evaluation×1"
+    stages = " ".join(f"{stage}×{count:.0f}" for stage, count in sorted(metrics.breakdown("aipro_stage_active", "stage").items()))
+    line = (
+        f"[进度] 阶段:{stages or '-'}"
+        f" | 分支 {metrics.total('aipro_branches_completed_total'):.0f}/{metrics.total('aipro_branches_scheduled_total'):.0f}"
+        f" | 调用 {snapshot['calls']:.0f}（进行中 {metrics.total('aipro_api_in_flight'):.0f}，排队 {metrics.total('aipro_api_queue_depth'):.0f}）"
+        f" | 失败 {metrics.total('aipro_api_calls_total', status='error'):.0f} 重试 {metrics.total('aipro_api_retries_total'):.0f}"
+        f" | {tokens_per_second:.1f} tokens/s"
+        f" | 平均耗时 {metrics.histogram_mean('aipro_api_latency_seconds'):.1f}s"
+        f" 平均排队 {metrics.histogram_mean('aipro_api_queue_wait_seconds'):.1f}s"
+    )
+    return line, snapshot
+
+
+async def run_progress_view(interval: float = 5.0, stream=sys.stderr) -> None:
+    """定期向终端输出一行进度，直到任务被取消"""
+    previous = {}
+    while True:
+        await asyncio.sleep(interval)
+        line, previous = progress_line(previous, interval)
+        print(line, file=stream, flush=True)
@@ -0,0 +1,352 @@
+import contextvars
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Optional
+from config import OUTPUT_DIR  # 关键词: 配置导入, 输出目录
+from utils.text_utils import parse_score
+
+MANIFEST_FILE = "manifest.json"
+CATALOG_DB = "catalog.db"
+ARCHIVE_SUFFIX = ".tar.gz"
+
+# 会话目录名格式：<标题>_<YYYYmmdd_HHMMSS>，与 main.py 中的命名规则一致
+SESSION_DIR_PATTERN = re.compile(r"^(?P<title>.*)_(?P<timestamp>\d{8}_\d{6})$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    question TEXT,
+    title TEXT,
+    created_at TEXT,
+    finished_at TEXT,
+    duration REAL,
+    score REAL,
+    estimated_score REAL,  -- 自动优化后的估算评分，与评估器给出的 score 口径不同，不参与平均评分
+    branch_count INTEGER,
+    api_calls INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    total_words INTEGER,
+    archived INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions (created_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_score ON sessions (score);
+CREATE TABLE IF NOT EXISTS model_usage (
+    session_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    calls INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency REAL,
+    PRIMARY KEY (session_id, model)
+);
+CREATE INDEX IF NOT EXISTS idx_model_usage_model ON model_usage (model);
+"""
+
+
+def _connect(root_dir: str) -> sqlite3.Connection:
+    """打开（必要时创建）会话根目录下的索引数据库"""
+    Path(root_dir).mkdir(exist_ok=True, parents=True)
+    conn = sqlite3.connect(os.path.join(root_dir, CATALOG_DB))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    # 旧版本创建的索引没有 estimated_score 列，打开时补上
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(sessions)")}
+    if "estimated_score" not in columns:
+        conn.execute("ALTER TABLE sessions ADD COLUMN estimated_score REAL")
+    return conn
+
+
+# 当前会话的用量累加器。asyncio 创建任务时会复制上下文，因此在会话开始时设置一次，其内部
+# gather/create_task 产生的所有子任务的调用都会计入；同一进程中并发运行的多个会话互不影响
+_session_usage: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("session_usage", default=None)
+
+
+def start_session_usage() -> dict:
+    """为当前上下文（及之后创建的子任务）开启新的用量累加器并返回，字段与会话清单一致"""
+    usage = {"API调用次数": 0, "返回字数": 0, "模型用量": {}}
+    _session_usage.set(usage)
+    return usage
+
+
+def merge_usage(target: dict, usage: dict) -> None:
+    """把一份用量（如 worker 上报的任务用量）累加到 target 中"""
+    target["API调用次数"] += usage.get("API调用次数", 0)
+    target["返回字数"] += usage.get("返回字数", 0)
+    for model, stats in usage.get("模型用量", {}).items():
+        total = target["模型用量"].setdefault(
+            model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0}
+        )
+        for key, value in stats.items():
+            total[key] = total.get(key, 0) + value
+
+
+def add_session_usage(usage: dict) -> None:
+    """把用量计入当前上下文的会话；当前上下文没有会话时什么也不做"""
+    target = _session_usage.get()
+    if target is not None:
+        merge_usage(target, usage)
+
+
+def record_call_usage(model: str, prompt_tokens: int, completion_tokens: int, latency: float, words: int) -> None:
+    """把一次成功的API调用计入当前会话"""
+    add_session_usage({
+        "API调用次数": 1,
+        "返回字数": words,
+        "模型用量": {model: {"calls": 1, "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens, "latency": latency}},
+    })
+
+
+def write_manifest(session_dir: str, manifest: dict) -> None:
+    """原子写入会话清单：先写临时文件，再用 os.replace 替换，避免中途崩溃留下半个文件"""
+    path = Path(session_dir)
+    path.mkdir(exist_ok=True, parents=True)
+    tmp_path = path / f".{MANIFEST_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path / MANIFEST_FILE)
+
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def read_manifest(session_dir: str) -> dict:
+    """读取会话清单，不存在或损坏时返回空字典"""
+    return _read_json(os.path.join(session_dir, MANIFEST_FILE))
+
+
+def _upsert(conn: sqlite3.Connection, manifest: dict) -> None:
+    model_usage = manifest.get("模型用量", {})
+    conn.execute(
+        """INSERT OR REPLACE INTO sessions (session_id, question, title, created_at, finished_at, duration,
+           score, estimated_score, branch_count, api_calls, prompt_tokens, completion_tokens, total_words, archived)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            manifest["会话ID"],
+            manifest.get("问题", ""),
+            manifest.get("标题", ""),
+            manifest.get("开始时间", ""),
+            manifest.get("结束时间", ""),
+            manifest.get("耗时", 0.0),
+            parse_score(manifest.get("评分")),
+            parse_score(manifest.get("优化后评分")),
+            manifest.get("分支数", 0),
+            manifest.get("API调用次数", 0),
+            sum(stats.get("prompt_tokens", 0) for stats in model_usage.values()),
+            sum(stats.get("completion_tokens", 0) for stats in model_usage.values()),
+            manifest.get("返回字数", 0),
+            1 if manifest.get("已归档") else 0,
+        ),
+    )
+    conn.execute("DELETE FROM model_usage WHERE session_id = ?", (manifest["会话ID"],))
+    conn.executemany(
+        "INSERT INTO model_usage (session_id, model, calls, prompt_tokens, completion_tokens, latency) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                manifest["会话ID"],
+                model,
+                stats.get("calls", 0),
+                stats.get("prompt_tokens", 0),
+                stats.get("completion_tokens", 0),
+                stats.get("latency", 0.0),
+            )
+            for model, stats in model_usage.items()
+        ],
+    )
+
+
+def record_session(session_dir: str, manifest: dict) -> None:
+    """工作流结束时调用：写入会话清单，并在单个事务中更新上级目录的索引"""
+    session_dir = os.path.abspath(session_dir)
+    manifest = dict(manifest, 会话ID=os.path.basename(session_dir))
+    write_manifest(session_dir, manifest)
+    conn = _connect(os.path.dirname(session_dir))
+    try:
+        with conn:  # 事务：要么全部写入，要么全部回滚
+            _upsert(conn, manifest)
+    finally:
+        conn.close()
+
+
+def _manifest_from_legacy_dir(session_dir: str) -> dict:
+    """为没有清单的旧会话目录，从目录名和文本日志中尽量还原基本信息"""
+    name = os.path.basename(session_dir)
+    manifest = {"会话ID": name, "问题": name, "标题": "", "评分": None, "分支数": 0}
+    match = SESSION_DIR_PATTERN.match(name)
+    if match:
+        manifest["问题"] = match.group("title")
+        created = datetime.datetime.strptime(match.group("timestamp"), "%Y%m%d_%H%M%S")
+        manifest["开始时间"] = created.isoformat(timespec="seconds")
+
+    report_path = os.path.join(session_dir, "final_report.md")
+    if os.path.exists(report_path):
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = f.read()
+        title_match = re.match(r"#\s*(.+)", report)
+        if title_match:
+            manifest["标题"] = title_match.group(1).strip()
+        score_match = re.search(r"评分：\s*(\d+(?:\.\d+)?)\s*/\s*10", report)
+        if score_match:
+            manifest["评分"] = float(score_match.group(1))
+
+    history_path = os.path.join(session_dir, "researcher_history.txt")
+    if os.path.exists(history_path):
+        with open(history_path, "r", encoding="utf-8") as f:
+            manifest["分支数"] = len(re.findall(r"^Topic \d+:", f.read(), re.MULTILINE))
+    return manifest
+
+
+def rebuild_index(root_dir: str = OUTPUT_DIR, backfill: bool = True) -> int:
+    """扫描根目录重建索引；backfill 为 True 时为旧会话补写清单。返回索引的会话数"""
+    conn = _connect(root_dir)
+    count = 0
+    try:
+        with conn:
+            conn.execute("DELETE FROM sessions")
+            conn.execute("DELETE FROM model_usage")
+            for entry in os.scandir(root_dir):
+                if entry.is_dir():
+                    manifest = read_manifest(entry.path)
+                    if not manifest:
+                        # 只补写符合会话目录命名规则的旧目录，其他目录（如检查点、手工创建的目录）不当作会话
+                        if not backfill or not SESSION_DIR_PATTERN.match(entry.name):
+                            continue
+                        manifest = _manifest_from_legacy_dir(entry.path)
+                        write_manifest(entry.path, manifest)
+                    manifest["会话ID"] = entry.name
+                elif entry.name.endswith(ARCHIVE_SUFFIX):
+                    # 已压缩的会话：清单以 <会话ID>.manifest.json 的形式保留在归档旁边
+                    session_id = entry.name[: -len(ARCHIVE_SUFFIX)]
+                    manifest = _read_json(os.path.join(root_dir, f"{session_id}.{MANIFEST_FILE}"))
+                    if not manifest:
+                        continue
+                    manifest.update(会话ID=session_id, 已归档=True)
+                else:
+                    continue
+                _upsert(conn, manifest)
+                count += 1
+    finally:
+        conn.close()
+    return count
+
+
+def _build_filters(keyword: str = None, since: str = None, until: str = None,
+                   min_score: float = None, max_score: float = None, model: str = None):
+    clauses, params = [], []
+    if keyword:
+        # 转义 LIKE 通配符，让关键词中的 % 和 _ 按字面匹配
+        escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        clauses.append("(s.question LIKE ? ESCAPE '\\' OR s.title LIKE ? ESCAPE '\\')")
+        params += [f"%{escaped}%", f"%{escaped}%"]
+    if since:
+        clauses.append("s.created_at >= ?")
+        params.append(since)
+    if until:
+        # 没有开始时间的会话不参与按日期的筛选，避免被当作最早的会话压缩或删除
+        clauses.append("s.created_at != '' AND s.created_at < ?")
+        params.append(until)
+    if min_score is not None:
+        clauses.append("s.score >= ?")
+        params.append(min_score)
+    if max_score is not None:
+        clauses.append("s.score <= ?")
+        params.append(max_score)
+    if model:
+        clauses.append("EXISTS (SELECT 1 FROM model_usage m2 WHERE m2.session_id = s.session_id AND m2.model = ?)")
+        params.append(model)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def list_sessions(root_dir: str = OUTPUT_DIR, limit: int = None, order_by: str = "created_at", **filters) -> list:
+    """按条件列出会话，filters 支持 keyword/since/until/min_score/max_score/model"""
+    if order_by not in ("created_at", "score", "duration", "api_calls"):
+        raise ValueError(f"不支持的排序字段：{order_by}")
+    where, params = _build_filters(**filters)
+    sql = f"SELECT s.* FROM sessions s {where} ORDER BY s.{order_by} DESC"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    conn = _connect(root_dir)
+    try:
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def aggregate_by_model(root_dir: str = OUTPUT_DIR, **filters) -> list:
+    """按模型聚合：会话数、平均评分、token 总量与平均单次调用耗时"""
+    where, params = _build_filters(**filters)
+    sql = f"""SELECT m.model AS model,
+                     COUNT(DISTINCT m.session_id) AS sessions,
+                     AVG(s.score) AS mean_score,
+                     SUM(m.calls) AS calls,
+                     SUM(m.prompt_tokens) AS prompt_tokens,
+                     SUM(m.completion_tokens) AS completion_tokens,
+                     SUM(m.latency) / NULLIF(SUM(m.calls), 0) AS mean_latency
+              FROM model_usage m JOIN sessions s ON s.session_id = m.session_id
+              {where}
+              GROUP BY m.model ORDER BY calls DESC"""
+    conn = _connect(root_dir)
+    try:
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def compress_session(session_id: str, root_dir: str = OUTPUT_DIR) -> str:
+    """将会话目录打包为 tar.gz 并删除原目录，清单副本保留在归档旁边以便重建索引"""
+    session_dir = os.path.join(root_dir, session_id)
+    if not os.path.isdir(session_dir):
+        raise FileNotFoundError(f"会话目录不存在：{session_dir}")
+    manifest = read_manifest(session_dir) or _manifest_from_legacy_dir(session_dir)
+    manifest.update(会话ID=session_id, 已归档=True)
+    archive = shutil.make_archive(session_dir, "gztar", root_dir=root_dir, base_dir=session_id)
+    with open(os.path.join(root_dir, f"{session_id}.{MANIFEST_FILE}"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(session_dir)
+    conn = _connect(root_dir)
+    try:
+        with conn:
+            _upsert(conn, manifest)
+    finally:
+        conn.close()
+    return archive
+
+
+def prune_sessions(session_ids: list, root_dir: str = OUTPUT_DIR) -> int:
+    """从索引中移除指定会话，并删除其目录或归档。返回删除的会话数
+
+    先提交索引的删除再删除文件：事务失败时文件原样保留，不会出现索引指向已删除目录的情况；
+    文件删除中途失败时，剩下的目录仍带有清单，可通过 rebuild_index 重新加入索引。
+    """
+    conn = _connect(root_dir)
+    try:
+        with conn:
+            for session_id in session_ids:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                conn.execute("DELETE FROM model_usage WHERE session_id = ?", (session_id,))
+    finally:
+        conn.close()
+    for session_id in session_ids:
+        session_dir = os.path.join(root_dir, session_id)
+        if os.path.isdir(session_dir):
+            shutil.rmtree(session_dir)
+        for leftover in (f"{session_id}{ARCHIVE_SUFFIX}", f"{session_id}.{MANIFEST_FILE}"):
+            leftover_path = os.path.join(root_dir, leftover)
+            if os.path.exists(leftover_path):
+                os.remove(leftover_path)
+    return len(session_ids)
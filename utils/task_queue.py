@@ -0,0 +1,221 @@
+import asyncio
+import contextlib
+import json
+import sqlite3
+import time
+import uuid
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending / running / done / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, id);
+CREATE TABLE IF NOT EXISTS rate_events (
+    name TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rate_events ON rate_events (name, ts);
+CREATE TABLE IF NOT EXISTS rate_slots (
+    name TEXT NOT NULL,
+    owner TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """每次操作使用独立连接，便于在 asyncio.to_thread 中调用，也适合多进程共享同一个文件"""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+
+@contextlib.contextmanager
+def _transaction(path: str):
+    """BEGIN IMMEDIATE 事务：立即获取写锁，保证多个进程领取任务时不会重复"""
+    conn = _connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+class TaskQueue:
+    """基于 SQLite 文件的持久任务队列，无需外部服务；放在共享存储上即可供多台机器使用
+
+    任务被领取后进入租约期，执行者需要定期 heartbeat 续约；租约过期的任务会被其他执行者重新领取，
+    失败的任务在达到 max_attempts 之前自动重试。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        conn = _connect(path)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def enqueue(self, kind: str, payload: dict, max_attempts: int = 3) -> int:
+        now = time.time()
+        with _transaction(self.path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO tasks (kind, payload, max_attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), max_attempts, now, now),
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker_id: str, lease_seconds: float = 60, kinds: list = None) -> dict:
+        """领取一个待执行或租约已过期的任务，没有可领取的任务时返回 None"""
+        now = time.time()
+        kind_filter = f"AND kind IN ({','.join('?' * len(kinds))})" if kinds else ""
+        with _transaction(self.path) as conn:
+            # 租约过期且已用完重试次数的任务直接标记为失败
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', error = COALESCE(error, '租约过期'), updated_at = ? "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                (now, now),
+            )
+            row = conn.execute(
+                f"SELECT * FROM tasks WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?)) "
+                f"{kind_filter} ORDER BY id LIMIT 1",
+                [now] + list(kinds or []),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row["id"]),
+            )
+        task = dict(row)
+        task["payload"] = json.loads(task["payload"])
+        task["attempts"] += 1
+        return task
+
+    def heartbeat(self, task_id: int, worker_id: str, lease_seconds: float = 60) -> bool:
+        """续约；返回 False 表示租约已被他人接管，当前执行者应放弃该任务"""
+        with _transaction(self.path) as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_expires = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (time.time() + lease_seconds, time.time(), task_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id: int, worker_id: str, result) -> bool:
+        with _transaction(self.path) as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (json.dumps(result, ensure_ascii=False), time.time(), task_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, task_id: int, worker_id: str, error: str) -> None:
+        """记录失败：未用完重试次数时放回队列，否则标记为最终失败"""
+        with _transaction(self.path) as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (error, time.time(), task_id, worker_id),
+            )
+
+    def get(self, task_ids: list) -> dict:
+        """返回 {任务ID: 任务记录}"""
+        conn = _connect(self.path)
+        try:
+            rows = conn.execute(
+                f"SELECT id, kind, status, attempts, result, error FROM tasks WHERE id IN ({','.join('?' * len(task_ids))})",
+                task_ids,
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row["id"]: dict(row) for row in rows}
+
+    async def wait_for(self, task_ids: list, poll_interval: float = 1.0, on_done=None) -> list:
+        """等待一组任务全部结束，按传入顺序返回结果；任一任务最终失败时抛出 RuntimeError
+
+        on_done(task_id, result) 会在每个任务完成后被调用一次，便于调用方逐个处理结果。
+        """
+        reported = set()
+        while True:
+            tasks = await asyncio.to_thread(self.get, task_ids)
+            if on_done is not None:
+                for task_id in task_ids:
+                    if task_id not in reported and tasks[task_id]["status"] == "done":
+                        reported.add(task_id)
+                        on_done(task_id, json.loads(tasks[task_id]["result"]))
+            failed = [t for t in tasks.values() if t["status"] == "failed"]
+            if failed:
+                raise RuntimeError(f"任务 {failed[0]['id']} 在 {failed[0]['attempts']} 次尝试后失败：{failed[0]['error']}")
+            if all(tasks[i]["status"] == "done" for i in task_ids):
+                return [json.loads(tasks[i]["result"]) for i in task_ids]
+            await asyncio.sleep(poll_interval)
+
+
+class RateLimiter:
+    """跨进程的速率限制：同一个 SQLite 文件上的所有执行者共享每分钟请求数与并发数上限
+
+    并发名额带有过期时间，持有者进程崩溃后名额会在 slot_ttl 秒后自动释放。
+    """
+
+    def __init__(self, path: str, name: str = "api", max_per_minute: int = 60, max_concurrent: int = 6,
+                 slot_ttl: float = 600, poll_interval: float = 0.5):
+        TaskQueue(path)  # 确保表结构存在
+        self.path = path
+        self.name = name
+        self.max_per_minute = max_per_minute
+        self.max_concurrent = max_concurrent
+        self.slot_ttl = slot_ttl
+        self.poll_interval = poll_interval
+
+    def try_acquire(self) -> str:
+        """尝试获取一个名额，成功返回名额标识，否则返回 None"""
+        now = time.time()
+        with _transaction(self.path) as conn:
+            conn.execute("DELETE FROM rate_events WHERE name = ? AND ts < ?", (self.name, now - 60))
+            conn.execute("DELETE FROM rate_slots WHERE name = ? AND expires < ?", (self.name, now))
+            recent = conn.execute("SELECT COUNT(*) FROM rate_events WHERE name = ?", (self.name,)).fetchone()[0]
+            active = conn.execute("SELECT COUNT(*) FROM rate_slots WHERE name = ?", (self.name,)).fetchone()[0]
+            if recent >= self.max_per_minute or active >= self.max_concurrent:
+                return None
+            owner = uuid.uuid4().hex
+            conn.execute("INSERT INTO rate_events (name, ts) VALUES (?, ?)", (self.name, now))
+            conn.execute("INSERT INTO rate_slots (name, owner, expires) VALUES (?, ?, ?)", (self.name, owner, now + self.slot_ttl))
+            return owner
+
+    def release(self, owner: str) -> None:
+        with _transaction(self.path) as conn:
+            conn.execute("DELETE FROM rate_slots WHERE owner = ?", (owner,))
+
+    @contextlib.asynccontextmanager
+    async def limit(self):
+        """在名额内执行一次API调用"""
+        while True:
+            owner = await asyncio.to_thread(self.try_acquire)
+            if owner:
+                break
+            await asyncio.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.release, owner)
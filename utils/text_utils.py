@@ -15,4 +15,16 @@ def extract_json(text: str) -> str:
     match = re.search(pattern, text)
     if match:
         return match.group(1).strip()
-    return "" 
\ No newline at end of file
+    return "" 
+
+def parse_score(value) -> float:
+    """
+    把AI返回的评分解析为数值，兼容 8、"8"、"8/10"、"8.5分" 等写法。
+    无法解析时返回 None。
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"\d+(?:\.\d+)?", str(value or ""))
+    return float(match.group(0)) if match else None
@@ -0,0 +1,21 @@
+import argparse
+import asyncio
+from modules.distributed import run_worker
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分布式 worker：从共享任务队列领取研究与评估任务并执行")
+    parser.add_argument("--queue", default="output/tasks.db", help="共享任务队列文件（需与编排端一致）")
+    parser.add_argument("--concurrency", type=int, default=3, help="本进程同时执行的任务数")
+    parser.add_argument("--lease", type=float, default=60, help="任务租约秒数")
+    parser.add_argument("--max-per-minute", type=int, default=60, help="所有 worker 共享的每分钟API请求上限")
+    parser.add_argument("--max-concurrent", type=int, default=6, help="所有 worker 共享的并发API调用上限")
+    parser.add_argument("--idle-exit", type=float, help="空闲超过该秒数后退出（默认一直运行）")
+    args = parser.parse_args()
+    asyncio.run(run_worker(
+        args.queue,
+        concurrency=args.concurrency,
+        lease_seconds=args.lease,
+        max_per_minute=args.max_per_minute,
+        max_concurrent=args.max_concurrent,
+        idle_exit=args.idle_exit
+    ))
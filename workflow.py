@@ -1,22 +1,66 @@
 import asyncio
 import datetime
+import os
 import re
 import json
+import time
+from typing import AsyncIterator
 from modules.decomposer import Decomposer
 from modules.researcher import Researcher
 from modules.synthesizer import Synthesizer
 from modules.evaluator import Evaluator
+from modules.distributed import DistributedExecutor
 from utils.file_utils import write_json, write_text
 from config import OUTPUT_DIR, WORKFLOW_STAGES
 from utils.resource_tracker import write_summary_doc
+from utils.session_catalog import record_session, start_session_usage
+from utils.text_utils import parse_score
+from utils.metrics import StageTracker, metrics
+from utils.events import (
+    echo, emit, set_event_sink, set_quiet, WorkflowEvent, StageStarted, DecompositionReady,
+    ReportAssembled, EvaluationReady, OptimizationReady, WorkflowCompleted,
+)
 
 class AutoQASystem:
-    def __init__(self, output_dir: str = OUTPUT_DIR):
+    def __init__(self, output_dir: str = OUTPUT_DIR, queue_path: str = None, batch_clients: tuple = None,
+                 max_per_minute: int = 60, max_concurrent: int = 6, num_generators: int = 3, group_size: int = 20,
+                 keep_per_group: int = 10, final_candidates: int = 30):
+        """
+        queue_path: 可选的共享任务队列文件。设置后分支研究与评估交给 worker.py 进程执行，
+                    需要在能访问同一文件与会话目录的机器上启动 worker。
+        max_per_minute / max_concurrent: 设置 queue_path 时，本进程与所有 worker 共享的每分钟请求数与并发调用上限，
+                    应与 worker 的设置一致。
+        batch_clients: 可选的 (主账号, 研究账号) 批处理客户端，见 modules.batch_client.create_batch_clients。
+                       设置后所有阶段的请求都通过批处理接口提交，适合不需要即时结果的批量任务。
+        num_generators / group_size / keep_per_group / final_candidates: 话题分解的宽度，原样传给 Decomposer。
+        """
         self.output_dir = output_dir
-        self.decomposer = Decomposer(output_dir)
+        self.decomposer = Decomposer(
+            output_dir,
+            num_generators=num_generators,
+            group_size=group_size,
+            keep_per_group=keep_per_group,
+            final_candidates=final_candidates
+        )
         self.researcher = Researcher(output_dir)
         self.synthesizer = Synthesizer(output_dir)
         self.evaluator = Evaluator(output_dir)
+        self.distributed = DistributedExecutor(
+            queue_path, max_per_minute=max_per_minute, max_concurrent=max_concurrent
+        ) if queue_path else None
+        if self.distributed:
+            # 本系统自己的调用同样计入共享速率限制，只作用于这里的客户端，不影响进程内其他系统
+            self._use_clients(*self.distributed.create_clients())
+        if batch_clients:
+            self._use_clients(*batch_clients)
+
+    def _use_clients(self, api_client, research_api_client) -> None:
+        """替换各模块使用的主账号与研究账号客户端"""
+        for module in (self.decomposer, self.researcher, self.synthesizer, self.evaluator):
+            module.api_client = api_client
+            module.research_api_client = research_api_client
+            if hasattr(module, "clients"):
+                module.clients = [api_client, research_api_client]
 
     def clean_think_tags(self, text: str) -> str:
         """清理think标签及其内容，包括处理嵌套标签的情况"""
@@ -35,48 +79,148 @@ class AutoQASystem:
         
         return text.strip()
 
-    async def execute_workflow(self, question: str, cognitive: str, goal: str, custom_branch: str = "") -> dict:
-        """执行完整的工作流程"""
-        print(f"步骤1：问题分解中...")
-        decomposition = await self.decomposer.decompose_question(question, cognitive, goal, custom_branch)
-        print(f"步骤1完成：问题分解结果已保存至 {self.output_dir}/分解结构.json")
-
-        print("\n步骤2：并行研究子问题中...")
-        sub_answers = await self.researcher.parallel_research(
-            questions=decomposition["子问题"],
-            main_topic=question  # 传入主要研究主题
-        )
-        print("步骤2完成：并行研究结果已全部返回.")
+    def _flatten_tree(self, tree: list, prefix: str = "") -> tuple:
+        """把递归研究树展开为 (标题列表, 内容列表)，子节点标题带上父级路径，内容已去除think标签"""
+        titles, contents = [], []
+        for node in tree:
+            title = f"{prefix}{node['标题']}"
+            titles.append(title)
+            contents.append(self.clean_think_tags(node["内容"]))
+            child_titles, child_contents = self._flatten_tree(node.get("子分支", []), f"{title} / ")
+            titles += child_titles
+            contents += child_contents
+        return titles, contents
+
+    async def _evaluate(self, content: str) -> dict:
+        """评估报告；启用分布式模式时交给 worker 执行"""
+        if self.distributed:
+            return await self.distributed.evaluate(content, self.output_dir)
+        return await self.evaluator.evaluate_and_optimize(content)
+
+    @staticmethod
+    def _score_text(score) -> str:
+        """报告中显示的评分：能解析为数值时统一格式，避免 8/10 这样的评分显示成 8/10/10"""
+        value = parse_score(score)
+        return str(score) if value is None else f"{value:g}"
+
+    def _enter_stage(self, stages: StageTracker, stage: str = None) -> None:
+        """切换本次工作流的阶段：更新监控指标，并向事件流发出阶段开始事件"""
+        stages.enter(stage)
+        if stage is not None:
+            emit(StageStarted(stage=stage))
+
+    def _start_session_stats(self) -> dict:
+        """记录会话开始时间，并为本次会话开启独立的用量累加器（并发运行的其他会话不会计入）"""
+        return {
+            "开始时间": datetime.datetime.now().isoformat(timespec="seconds"),
+            "start": time.monotonic(),
+            "usage": start_session_usage(),
+        }
 
-        print("\n步骤3：开始评估和优化...")
-        # 将研究结果整合成一个完整的报告
-        report_content = ""
-        for q, a in zip(decomposition["子问题"], sub_answers):
-            report_content += f"## {q['标题']}\n\n{a}\n\n"
+    def _record_session(self, stats: dict, question: str, branch_count: int, evaluation: dict) -> None:
+        """工作流结束时写入会话清单并更新目录索引"""
+        usage = stats["usage"]
+        manifest = {
+            "问题": question,
+            "标题": evaluation.get("标题", ""),
+            "开始时间": stats["开始时间"],
+            "结束时间": datetime.datetime.now().isoformat(timespec="seconds"),
+            "耗时": round(time.monotonic() - stats["start"], 2),
+            "评分": parse_score(evaluation.get("评分")),
+            # 优化后的评分是按章节估算的，与评估器的整体评分口径不同，单独记录
+            "优化后评分": evaluation.get("优化结果", {}).get("优化后评分"),
+            "分支数": branch_count,
+            "API调用次数": usage["API调用次数"],
+            "返回字数": usage["返回字数"],
+            "模型用量": usage["模型用量"],
+        }
+        record_session(self.output_dir, manifest)
 
-        # 使用新的评估和优化方法
-        evaluation = await self.evaluator.evaluate_and_optimize(report_content)
+    async def execute_workflow(self, question: str, cognitive: str, goal: str, custom_branch: str = "",
+                               research_depth: int = 0, max_research_calls: int = 200, max_research_tokens: int = None,
+                               optimize_rounds: int = 0, target_score: float = 8, max_optimize_calls: int = 30,
+                               synthesis_analysis: bool = False) -> dict:
+        """执行完整的工作流程
         
-        # 在生成最终markdown之前，清理所有内容中的think标签
-        report_content = self.clean_think_tags(report_content)
-        if evaluation.get('评分理由'):
-            evaluation['评分理由'] = self.clean_think_tags(evaluation['评分理由'])
-        if evaluation.get('优化建议'):
-            evaluation['优化建议'] = [self.clean_think_tags(suggestion) for suggestion in evaluation['优化建议']]
-        if evaluation.get('事实更正'):
-            evaluation['事实更正'] = [self.clean_think_tags(correction) for correction in evaluation['事实更正']]
-
-        # 生成最终的markdown文件
-        final_md_content = f"""# {evaluation['标题']}
-
-{report_content}
-
-## 质量评估
-
-- 评分：{evaluation['评分']}/10
-- 评分理由：{evaluation['评分理由']}
-
-## 优化建议
+        research_depth 大于 0 时启用递归研究：每个分支可继续分解为子分支，直到该层级，
+        调用次数与 token 总量分别受 max_research_calls、max_research_tokens 限制。
+        optimize_rounds 大于 0 时根据评估建议改写相关章节，最多迭代该轮数，
+        达到 target_score 或用完 max_optimize_calls 次调用时提前停止。
+        synthesis_analysis 为 True 时，以并行树形归纳生成执行摘要、分支间矛盾与推荐阅读顺序，放在报告开头。
+        """
+        session_stats = self._start_session_stats()
+        stages = metrics.stage_tracker()
+        try:
+            self._enter_stage(stages, "decomposition")
+            echo(f"步骤1：问题分解中...")
+            decomposition = await self.decomposer.decompose_question(question, cognitive, goal, custom_branch)
+            emit(DecompositionReady(decomposition=decomposition))
+            echo(f"步骤1完成：问题分解结果已保存至 {self.output_dir}/分解结构.json")
+
+            self._enter_stage(stages, "research")
+            echo("\n步骤2：并行研究子问题中...")
+            if research_depth > 0:
+                research_tree = await self.researcher.recursive_research(
+                    questions=decomposition["子问题"],
+                    main_topic=question,
+                    max_depth=research_depth,
+                    max_calls=max_research_calls,
+                    max_tokens=max_research_tokens
+                )
+                write_json("研究树.json", research_tree, output_dir=self.output_dir)
+                echo(f"步骤2完成：递归研究树已保存至 {self.output_dir}/研究树.json")
+            elif self.distributed:
+                sub_answers = await self.distributed.parallel_research(
+                    questions=decomposition["子问题"],
+                    main_topic=question,
+                    output_dir=self.output_dir
+                )
+                echo("步骤2完成：worker 研究结果已全部返回.")
+            else:
+                sub_answers = await self.researcher.parallel_research(
+                    questions=decomposition["子问题"],
+                    main_topic=question  # 传入主要研究主题
+                )
+                echo("步骤2完成：并行研究结果已全部返回.")
+
+            self._enter_stage(stages, "synthesis")
+            echo("\n步骤3：开始评估和优化...")
+            # 将研究结果整合成一个完整的报告
+            if research_depth > 0:
+                report_content = await self.synthesizer.synthesize_tree_report(research_tree, heading_level=2)
+            else:
+                report_content = ""
+                for q, a in zip(decomposition["子问题"], sub_answers):
+                    report_content += f"## {q['标题']}\n\n{a}\n\n"
+
+            if synthesis_analysis:
+                if research_depth > 0:
+                    branch_titles, branch_contents = self._flatten_tree(research_tree)
+                else:
+                    branch_titles = [q["标题"] for q in decomposition["子问题"]]
+                    branch_contents = [self.clean_think_tags(a) for a in sub_answers]
+                analysis = await self.synthesizer.synthesize_with_analysis(branch_titles, branch_contents, main_topic=question)
+                write_json("归纳分析.json", analysis, output_dir=self.output_dir)
+                report_content = self.synthesizer.render_analysis(analysis) + report_content
+            emit(ReportAssembled(content=report_content))
+
+            self._enter_stage(stages, "evaluation")
+            # 使用新的评估和优化方法
+            evaluation = await self._evaluate(report_content)
+            emit(EvaluationReady(evaluation=evaluation))
+            
+            # 在生成最终markdown之前，清理所有内容中的think标签
+            report_content = self.clean_think_tags(report_content)
+            if evaluation.get('评分理由'):
+                evaluation['评分理由'] = self.clean_think_tags(evaluation['评分理由'])
+            if evaluation.get('优化建议'):
+                evaluation['优化建议'] = [self.clean_think_tags(suggestion) for suggestion in evaluation['优化建议']]
+            if evaluation.get('事实更正'):
+                evaluation['事实更正'] = [self.clean_think_tags(correction) for correction in evaluation['事实更正']]
+
+            optimize_info = ""
+            score_label = "评分"
+            feedback = f"""## 优化建议
 
 {''.join([f'- {suggestion}\n' for suggestion in evaluation['优化建议']])}
 
@@ -84,61 +228,106 @@ class AutoQASystem:
 
 {''.join([f'- {correction}\n' for correction in evaluation['事实更正']])}
 """
+            if optimize_rounds > 0:
+                self._enter_stage(stages, "optimization")
+                echo("\n步骤4：根据评估建议优化报告...")
+                optimization = await self.evaluator.optimize_report(
+                    report_content, evaluation,
+                    target_score=target_score,
+                    max_iterations=optimize_rounds,
+                    max_calls=max_optimize_calls
+                )
+                report_content = optimization["报告内容"]
+                emit(OptimizationReady(optimization=optimization))
+                evaluation["优化结果"] = {key: value for key, value in optimization.items() if key != "报告内容"}
+                optimize_info = f"- 优化后评分（估算）：{optimization['优化后评分']}/10，改写 {len(optimization['改写章节'])} 个章节\n"
+                score_label = "评分（优化前）"
+                # 已用于改写的建议不再作为待办列出
+                feedback = f"""## 已采纳的建议
+
+{''.join([f'- {item}\n' for item in optimization['已采纳建议']]) or '无\n'}
+
+## 尚未处理的建议
+
+{''.join([f'- {item}\n' for item in optimization['剩余建议']]) or '无\n'}
+"""
+                echo(f"步骤4完成：共 {optimization['迭代次数']} 轮，{optimization['调用次数']} 次调用")
 
-        write_text("final_report.md", final_md_content, output_dir=self.output_dir)
-        print(f"\n最终报告已保存至: {self.output_dir}/final_report.md")
+            # 生成最终的markdown文件
+            final_md_content = f"""# {evaluation['标题']}
 
-        return {
-            "报告内容": report_content,
-            "质量评估": evaluation
-        }
+{report_content}
+
+## 质量评估
+
+- {score_label}：{self._score_text(evaluation['评分'])}/10
+- 评分理由：{evaluation['评分理由']}
+{optimize_info}
+{feedback}"""
+
+            write_text("final_report.md", final_md_content, output_dir=self.output_dir)
+            echo(f"\n最终报告已保存至: {self.output_dir}/final_report.md")
+            self._record_session(session_stats, question, len(decomposition["子问题"]), evaluation)
+
+            return {
+                "报告内容": report_content,
+                "质量评估": evaluation
+            }
+        finally:
+            # 出错或被取消时同样结束当前阶段，避免阶段指标停留在进行中
+            self._enter_stage(stages)
 
     async def execute_workflow_from_step3(self):
         """从步骤3继续执行工作流"""
-        print("步骤3：开始整合研究结果并生成报告...")
-
-        # 读取分解结构获取标题
-        with open(f"{self.output_dir}/分解结构.json", "r", encoding="utf-8") as f:
-            decomposition = json.load(f)
-
-        # 读取之前的研究结果（从 researcher_history.txt 提取答案）
-        sub_answers = []
-        with open(f"{self.output_dir}/researcher_history.txt", "r", encoding="utf-8") as f:
-            content = f.read()
-            # 这里正则表达式提取每个答案中的内容
-            answers = re.findall(r"Answer: (.*?)-{40}", content, re.DOTALL)
-            sub_answers = [answer.strip() for answer in answers]
-
-        # 对应分解后的子问题标题
-        titles = [q["标题"] for q in decomposition["子问题"]]
-
-        # 这里不再调用事实核查，因为我们已把核查功能合并到 evaluator 中
-        # 将各分支研究结果统一包装成合成报告需要的格式
-        final_report = await self.synthesizer.synthesize_report({
-            "子问题": titles,
-            "研究结果": [{"修正内容": ans} for ans in sub_answers]
-        })
-
-        print("步骤4：评估报告质量并给出优化建议...")
-        evaluation = await self.evaluator.evaluate_and_optimize(final_report)
-
-        # 在生成最终markdown之前，清理所有内容中的think标签
-        final_report = self.clean_think_tags(final_report)
-        if evaluation.get('评分理由'):
-            evaluation['评分理由'] = self.clean_think_tags(evaluation['评分理由'])
-        if evaluation.get('优化建议'):
-            evaluation['优化建议'] = [self.clean_think_tags(suggestion) for suggestion in evaluation['优化建议']]
-        if evaluation.get('事实更正'):
-            evaluation['事实更正'] = [self.clean_think_tags(correction) for correction in evaluation['事实更正']]
-
-        # 生成最终的 markdown 文件
-        final_md_content = f"""# {evaluation['标题']}
+        echo("步骤3：开始整合研究结果并生成报告...")
+        session_stats = self._start_session_stats()
+        stages = metrics.stage_tracker()
+        try:
+            self._enter_stage(stages, "synthesis")
+
+            # 读取分解结构获取标题
+            with open(f"{self.output_dir}/分解结构.json", "r", encoding="utf-8") as f:
+                decomposition = json.load(f)
+
+            # 读取之前的研究结果（从 researcher_history.txt 提取答案）
+            sub_answers = []
+            with open(f"{self.output_dir}/researcher_history.txt", "r", encoding="utf-8") as f:
+                content = f.read()
+                # 这里正则表达式提取每个答案中的内容
+                answers = re.findall(r"Answer: (.*?)-{40}", content, re.DOTALL)
+                sub_answers = [answer.strip() for answer in answers]
+
+            # 对应分解后的子问题标题
+            titles = [q["标题"] for q in decomposition["子问题"]]
+
+            # 这里不再调用事实核查，因为我们已把核查功能合并到 evaluator 中
+            # 将各分支研究结果统一包装成合成报告需要的格式
+            final_report = await self.synthesizer.synthesize_report({
+                "子问题": titles,
+                "研究结果": [{"修正内容": ans} for ans in sub_answers]
+            })
+
+            echo("步骤4：评估报告质量并给出优化建议...")
+            self._enter_stage(stages, "evaluation")
+            evaluation = await self._evaluate(final_report)
+
+            # 在生成最终markdown之前，清理所有内容中的think标签
+            final_report = self.clean_think_tags(final_report)
+            if evaluation.get('评分理由'):
+                evaluation['评分理由'] = self.clean_think_tags(evaluation['评分理由'])
+            if evaluation.get('优化建议'):
+                evaluation['优化建议'] = [self.clean_think_tags(suggestion) for suggestion in evaluation['优化建议']]
+            if evaluation.get('事实更正'):
+                evaluation['事实更正'] = [self.clean_think_tags(correction) for correction in evaluation['事实更正']]
+
+            # 生成最终的 markdown 文件
+            final_md_content = f"""# {evaluation['标题']}
 
 {final_report}
 
 ## 质量评估
 
-- 评分：{evaluation['评分']}/10  
+- 评分：{self._score_text(evaluation['评分'])}/10  
 - 评分理由：{evaluation['评分理由']}
 
 ## 优化建议
@@ -149,10 +338,65 @@ class AutoQASystem:
 
 {''.join([f'- {correction}\n' for correction in evaluation['事实更正']])}
 """
-        write_text("final_report.md", final_md_content, output_dir=self.output_dir)
-        print(f"最终报告已保存至: {self.output_dir}/final_report.md")
-
-        return {"报告内容": final_report, "质量评估": evaluation}
+            write_text("final_report.md", final_md_content, output_dir=self.output_dir)
+            echo(f"最终报告已保存至: {self.output_dir}/final_report.md")
+            # 从步骤3继续时没有原始问题，沿用会话目录名作为问题
+            question = os.path.basename(os.path.normpath(self.output_dir))
+            self._record_session(session_stats, question, len(titles), evaluation)
+
+            return {"报告内容": final_report, "质量评估": evaluation}
+        finally:
+            # 出错或被取消时同样结束当前阶段，避免阶段指标停留在进行中
+            self._enter_stage(stages)
+
+    async def stream_workflow(self, question: str, cognitive: str, goal: str, custom_branch: str = "",
+                              quiet: bool = True, **options) -> AsyncIterator[WorkflowEvent]:
+        """以异步生成器的形式执行工作流，逐个产出类型化事件，供其他服务嵌入使用
+
+        工作流在独立任务中运行，事件产生后立即交给调用方，最后一个事件为 WorkflowCompleted。
+        quiet 为 True 时工作流内部经 echo 的进度输出被静默（只影响该任务，不影响调用方）。
+        其余关键字参数原样传给 execute_workflow。
+
+        取消：提前结束迭代（break 后 aclose，或使用 contextlib.aclosing）或取消调用方任务，
+        都会取消工作流任务及其所有进行中的API调用。工作流内部的异常会在迭代处重新抛出。
+
+        用法：
+            async with contextlib.aclosing(system.stream_workflow(q, c, g)) as events:
+                async for event in events:
+                    if isinstance(event, BranchCompleted):
+                        forward(event.title, event.content)
+        """
+        queue = asyncio.Queue()
+
+        async def run():
+            # 在任务自己的上下文中设置，仅对工作流及其子任务生效
+            set_event_sink(queue.put_nowait)
+            set_quiet(quiet)
+            try:
+                result = await self.execute_workflow(question, cognitive, goal, custom_branch, **options)
+                queue.put_nowait(WorkflowCompleted(result=result))
+            except BaseException as e:
+                # 包括子任务传出的 CancelledError 等非 Exception 的结束方式，保证调用方不会一直等待
+                queue.put_nowait(e)
+                if not isinstance(e, Exception):
+                    raise
+
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await queue.get()
+                if isinstance(event, asyncio.CancelledError):
+                    # 不是调用方取消的：转换为普通异常，避免被误当作调用方任务自身被取消
+                    raise RuntimeError("工作流在完成前被取消") from event
+                if isinstance(event, BaseException):
+                    raise event
+                yield event
+                if isinstance(event, WorkflowCompleted):
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
 
 if __name__ == "__main__":
     import asyncio